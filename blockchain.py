@@ -1,21 +1,34 @@
 import os
 import json
+import heapq
+import shutil
+import argparse
+import threading
 from time import time
-from src.utils import Generate, Write, Hash
-from src.validation import Transaction, ValidChain, ValidBlock, Hash_Validation
+from src.utils import Generate, Hash
+from src.validation import Transaction, ValidChain, ValidBlock, Hash_Validation, Signature, PublicKeys, Workers
 from src.epoch import Epoch
-from flask import Flask, request, jsonify
+from flask import Flask, request, jsonify, Response
 from Crypto.PublicKey import RSA
 import requests
 from urllib.parse import urlparse
 from src.broadcast import Broadcast
+from src.store import BlockStore, ChainView
+from src.checkpoint import Checkpoint
+from src.reorg import Reorg
+from src.codec import Codec, CodecError
+from src.indexes import BalanceIndex, AddressIndex, TransactionIndex, PendingBalances
+from src.models import BlockRecord, TransactionRecord
+from src.mempool_log import MempoolLog
+from src.reconcile import Reconcile
+from src.peers import Peers
 
 
 class Blockchain:
-    def __init__(self):
-        # list for storing the chain
-        self.chain = []
+    # blocks added between checkpoints
+    checkpoint_every = 100
 
+    def __init__(self, full_verify=False, fsync_every=1, fsync_interval=0):
         # port to run blockchain on
         self.port = input("input a port number: ")
 
@@ -36,33 +49,142 @@ class Blockchain:
         self.public_key_hex = wallet_file['public key hex']
         self.public_key_hash = wallet_file['public key hash']
 
+        # indexed block store that replaced chain.json, the chain itself is a lazy view over it
+        self.store = BlockStore('data/blocks', sync_every=fsync_every, sync_interval=fsync_interval)
+
+        # nodes that still have a chain.json get it imported into the store once.
+        # it is imported into a store of its own that only replaces data/blocks when it is complete,
+        # a crash part way through leaves the store empty so the import starts over on the next run
+        if len(self.store) == 0 and os.path.isfile('data/chain.json'):
+            print("importing data/chain.json into the block store")
+            self.store.close()
+            if os.path.exists('data/blocks.import'):
+                shutil.rmtree('data/blocks.import')
+            imported = BlockStore('data/blocks.import')
+            imported.import_json('data/chain.json')
+            imported.close()
+            shutil.rmtree('data/blocks')
+            os.rename('data/blocks.import', 'data/blocks')
+            os.rename('data/chain.json', 'data/chain.json.imported')
+            self.store = BlockStore('data/blocks', sync_every=fsync_every, sync_interval=fsync_interval)
+
         # if no chain exists, forges a genesis block
-        if not os.path.isfile('data/chain.json'):
+        if len(self.store) == 0:
             print("now generating genesis block")
-            Block.genesis(previous_hash='Times, Chancellor on brink of second bailout for banks', proof=30109)
+            self.store.append(Block.genesis(previous_hash='Times, Chancellor on brink of second bailout for banks',
+                                            proof=30109))
 
-        # attempting to read our json to the self.chain table.
-        # dont ask me how this works, as far as I'm concerned its witchcraft
-        # such a damn simple task seemingly, but this is the only syntax I could find to get the job done lmfao.
-        s = open('data/chain.json', 'r')
-        for line in s.readlines():
-            try:
-                j = line.split('|')[-1]
-                self.chain.append(json.loads(j))
+        # blocks are read from the store as they are needed rather than all held in memory
+        self.chain = ChainView(self.store)
 
-            except ValueError:
-                print("the json is rekt slut")
-                continue
+        # held while a block is checked and added or the chain switches branch, requests are handled on
+        # several threads and broadcasts finish in the background
+        self.lock = threading.RLock()
 
-        print("Now validating local chain, please wait.")
-        if ValidChain.valid_chain(self.chain):
+        # finish any reorg that was cut short by a crash before we look at the chain,
+        # the indexes are brought over from its undo records once they are open
+        self.reorg = Reorg('data/blocks/reorg.json')
+        journal = self.reorg.recover(self.chain)
+
+        # blocks up to the checkpoint were validated on a previous run, so we only check what came after
+        self.checkpoint = Checkpoint('data/blocks/checkpoint.json')
+        start = 0
+        if not full_verify:
+            start = self.checkpoint.load(self.public_key_hex, self.store)
+
+        # height of the last checkpoint, None while the local chain is invalid so nothing built on it gets one
+        self.checkpoint_height = None
+
+        print(f"Now validating local chain from block {start + 1}, please wait.")
+        if ValidChain.valid_chain_parallel(self.chain, start=start):
             print("Chain is valid")
+            self.save_checkpoint()
         else:
             print("Local chain is invalid, please sync the node with another upstream node.")
 
+        # indexes kept in step with the chain, picked up from their last commit and caught up
+        self.balances = BalanceIndex('data/indexes/balances.db')
+        self.addresses = AddressIndex('data/indexes/addresses.db')
+        self.transactions = TransactionIndex('data/indexes/transactions.db')
+        self.indexes = [self.balances, self.addresses, self.transactions]
+        undo = journal['undo'] if journal is not None else None
+        for index in self.indexes:
+            index.load(self.chain, undo)
+        self.reorg.finish()
+
         # current difficulty
         self.difficulty = self.last_block['difficulty'] or 5
 
+    def save_checkpoint(self):
+        """
+        records the current tip as validated
+        """
+        # the checkpoint must never point at a block that could still be lost in a crash
+        self.store.sync()
+        self.checkpoint.save(len(self.chain) - 1, self.last_block['current_hash'], self.private_key)
+        self.checkpoint_height = len(self.chain) - 1
+
+    def add_block(self, block):
+        """
+        appends a block to the chain and updates the indexes and the mempool, returns its height
+        """
+        height = self.chain.append(block)
+        # admissions wait until the mempool has caught up with the balances, or a confirmed
+        # transaction would count for its recipient twice, once in the index and once still pending
+        with mp.lock:
+            for index in self.indexes:
+                index.apply_block(height, block)
+            mp.block_connected(block)
+
+        # blocks are checked as they arrive, so the checkpoint moves along with them every so often
+        # and a restart doesn't validate everything received since the last one again
+        if self.checkpoint_height is not None and height - self.checkpoint_height >= self.checkpoint_every:
+            self.save_checkpoint()
+        return height
+
+    def find_transaction(self, transaction_hash):
+        """
+        looks up a confirmed transaction by hash, returns it with its block and confirmation count or None
+        """
+        location = self.transactions.location(transaction_hash)
+        if location is None:
+            return None
+
+        height, position = location
+        block = self.chain[height]
+        return {
+            'transaction': TransactionRecord.plain(block['transactions'][position]),
+            'block_index': block['index'],
+            'block_hash': block['current_hash'],
+            'confirmations': len(self.chain) - height
+        }
+
+    def switch_branch(self, fork, blocks):
+        """
+        reorganises the chain onto the given blocks after the fork height and brings the indexes along.
+        returns the undo records of the blocks that were disconnected
+        """
+        undo = self.reorg.apply(self.chain, fork, blocks)
+
+        # as in add_block, no admissions in between the balances moving and the mempool following them
+        with mp.lock:
+            for record in reversed(undo):
+                for index in self.indexes:
+                    index.revert_block(record['height'], record['block'])
+
+            for height in range(fork + 1, len(self.chain)):
+                block = self.chain[height]
+                for index in self.indexes:
+                    index.apply_block(height, block)
+
+            for index in self.indexes:
+                index.save()
+            self.reorg.finish()
+
+            mp.branch_switched([record['block'] for record in undo],
+                               [self.chain[height] for height in range(fork + 1, len(self.chain))])
+        return undo
+
     @property
     def last_proof(self):
         """
@@ -109,116 +231,574 @@ class Block:
     @staticmethod
     def genesis(proof, previous_hash=None):
         unix_time = time()
-        block = {
+        block = BlockRecord({
             'index': 1,
             'timestamp': unix_time,
             'transactions': [],
             'difficulty': 4,
             'proof': proof,
             'previous_hash': previous_hash
-        }
+        })
 
-        block_hash = Hash.hash(block)
+        # current_hash isn't part of what gets hashed, so it can be added to the same block
+        block['current_hash'] = block.header_hash()
 
-        block_with_hash = {
-            'index': 1,
-            'timestamp': unix_time,
-            'transactions': [],
-            'difficulty': 4,
-            'proof': proof,
-            'previous_hash': previous_hash,
-            'current_hash': block_hash
-        }
-
-        # opens the chain.json file and writes the genesis block to it
-        with open('data/chain.json', 'w') as f:
-            block_dict = json.dumps(block_with_hash)
-            f.write(block_dict)
-            f.write('\n')
+        return block
 
     @staticmethod
     def new_block(proof, time, mempool, previous_hash=None):
-        block = {
+        block_with_hash = BlockRecord({
             'index': len(blockchain.chain) + 1,
             'timestamp': time,
             'transactions': mempool,
             'difficulty': blockchain.difficulty,
             'proof': proof,
             'previous_hash': previous_hash
-        }
+        })
 
-        block_hash = Hash.hash(block)
+        block_with_hash['current_hash'] = block_with_hash.header_hash()
 
-        block_with_hash = {
-            'index': len(blockchain.chain) + 1,
-            'timestamp': time,
-            'transactions': mempool,
-            'difficulty': blockchain.difficulty,
-            'proof': proof,
-            'previous_hash': previous_hash,
-            'current_hash': block_hash
-        }
-
-        Write.write_chain(block_with_hash)
-        blockchain.chain.append(block_with_hash)
-        if block['index'] % Epoch.block_epoch == 0:
+        blockchain.add_block(block_with_hash)
+        if block_with_hash['index'] % Epoch.block_epoch == 0:
             if blockchain.check_epoch_time():
                 print(f"Difficulty adjusted to {blockchain.difficulty}")
 
-        # list for storing the failed nodes
-        failed_nodes = []
-        prefix = "http://"
+        # announced to every node at the same time, the miner gets its answer without waiting for them
+        Broadcast.fan_out(Broadcast.announce, Node.inventory(blocks=[block_with_hash]), node.nodes,
+                          on_done=Node.block_broadcast_done)
+
+        return block_with_hash
+
 
-        # iterate through nodes to broadcast the new block
-        for neighbour in node.nodes:
-            # Broadcast the block to the registered nodes
-            broadcast_status = Broadcast.broadcast_block(block=block_with_hash, node=neighbour)
+    @staticmethod
+    def receive_block(values):
+        """
+        checks a block sent to us by another node and adds it to the chain if it is the next one,
+        returns the (message, status code) to answer the sender with
+        """
+        # check all the block info has been submitted
+        required = ['index', 'timestamp', 'transactions', 'difficulty', 'proof', 'previous_hash', 'current_hash']
+        if not all(k in values for k in required):
+            # if not we return an error so the sending node can do something
+            return "block broadcast denied", 400
+
+        # hashed once here and reused when the block is stored and passed on
+        values = BlockRecord.wrap(values)
+
+        # checked and added under the chain lock, so two blocks for the same height can't both get in
+        with blockchain.lock:
+            # if all goes as planned we continue
+            index = values['index']
+            last_proof = blockchain.last_proof
+            last_block_index = blockchain.last_block['index']
+
+            # a block we already have, usually one of ours coming back from a peer we sent it to
+            if 0 < index <= last_block_index and \
+                    blockchain.chain[index - 1]['current_hash'] == values['current_hash']:
+                return "block already received", 200
+
+            in_order = index - last_block_index == 1
+
+            # call function to validate block
+            valid = in_order and ValidBlock.validate_received_block(values, last_proof, blockchain.difficulty)
+            if valid:
+                # if valid we append it to the local chain
+                # the mempool drops what the block confirmed when it is added
+                blockchain.add_block(values)
+                # check to see if the block index is the beginning of a new epoch to do difficulty calculations
+                if index % 100 == 0:
+                    blockchain.check_epoch_time()
+
+        if not in_order:
+            print('blocks out of order... resolving')
+            Node.resolve_conflicts()
+            return "out of order", 400
+
+        if not valid:
+            Node.resolve_conflicts()
+            # if the function returns False the block is denied.
+            return "block broadcast denied", 400
+
+        # announced to every node at the same time, they fetch it from us if they don't have it
+        Broadcast.fan_out(Broadcast.announce, Node.inventory(blocks=[values]), node.nodes,
+                          on_done=Node.block_broadcast_done)
+        return "ok", 200
 
-            # if a node times out or doesnt return a response we will add it to the failed nodes list
-            if broadcast_status == "TimeoutError":
-                failed_nodes.append(neighbour)
 
-            # if the broadcast is successful we clear the mempool
-            if broadcast_status:
-                mp.clear_mempool()
-                mp.clear_fees()
+class Mempool:
+    # most transactions accepted by /transactions/batch in one request
+    batch_limit = 10000
 
-            # if the broadcast is rejected we will resolve our chain.
-            if not broadcast_status:
-                Node.resolve_conflicts()
+    # how far below zero a pending balance can be before it counts as overdrawn, floating point sums drift a little
+    dust = 1e-9
 
-        # if the length of the failed node list is greater than zero
-        # we iterate through the list and remove those nodes.
-        if len(failed_nodes) > 0:
-            for neighbour in failed_nodes:
-                address = prefix + neighbour
-                Node.remove_node(address)
+    def __init__(self, max_count=None, max_bytes=None, block_max_bytes=None):
+        # pending transactions waiting to be added to a block, keyed by transaction_hash in the order they arrived
+        self.transactions = {}
 
-        return block_with_hash
+        # sender -> {transaction_hash: None} for every pending transaction from that address, in arrival order
+        self.senders = {}
 
+        # confirmed balances with every pending transaction applied, what admission checks funds against.
+        # the confirmed BalanceIndex underneath is attached once the chain is loaded
+        self.pending_balances = PendingBalances()
 
-class Mempool:
-    def __init__(self):
-        # pending transactions waiting to be added to a block
-        self.current_transactions = []
+        # held while a transaction is checked and added, so two submissions can't both pass the checks
+        self.lock = threading.RLock()
 
         # total pending fees
         self.pending_fees = 0
 
-    def clear_mempool(self):
-        self.current_transactions = []
+        # with any of these limits set the mempool is prioritised by fee per byte:
+        # the cheapest transactions are evicted when it is full and blocks take the best paying ones first
+        self.max_count = max_count
+        self.max_bytes = max_bytes
+        self.block_max_bytes = block_max_bytes
+        self.prioritised = any(limit is not None for limit in (max_count, max_bytes, block_max_bytes))
 
-    def clear_fees(self):
-        self.pending_fees = 0
+        # transaction_hash -> encoded size, the total, and a min heap of (fee rate, arrival number, transaction_hash).
+        # heap entries for transactions that have left the mempool are skipped when they come up
+        self.sizes = {}
+        self.total_bytes = 0
+        self.heap = []
+        self.arrivals = 0
+
+        # on disk copy of the mempool, see open_log
+        self.log = None
+
+    def __len__(self):
+        return len(self.transactions)
+
+    @staticmethod
+    def size_of(transaction):
+        """
+        size of a transaction in the binary encoding, what fee rates and block limits are measured in
+        """
+        transaction = TransactionRecord.plain(transaction)
+        try:
+            return len(Codec.encode_transaction(transaction))
+        except CodecError:
+            return len(json.dumps(transaction))
+
+    @staticmethod
+    def fee_of(transaction):
+        fee = transaction.get('fee')
+        if isinstance(fee, bool) or not isinstance(fee, (int, float)):
+            return 0
+        return fee
+
+    @staticmethod
+    def fee_rate(transaction, size):
+        return Mempool.fee_of(transaction) / size
+
+    def open_log(self, filename='data/mempool.dat'):
+        """
+        starts persisting the mempool to a log, returns the transactions that were pending
+        when the node last stopped. they are not in the mempool until revalidate() has checked them again
+        """
+        self.log = MempoolLog(filename)
+        pending = self.log.load()
+        if not pending and self.log.records:
+            self.log.rewrite([])
+        return pending
+
+    def revalidate(self, transactions):
+        """
+        runs reloaded transactions through the admission checks against the current tip,
+        meant to run in the background after startup. the log is compacted once they have all been seen
+        """
+        admitted = 0
+        for transaction in transactions:
+            values = TransactionRecord.plain(transaction)
+            if not isinstance(values, dict) or 'transaction_hash' not in values:
+                continue
+            message, status = self.admit_transaction(values, broadcast=False)
+            if status == 201:
+                admitted += 1
+            elif not self.transaction_in_pool(values) and self.log is not None:
+                self.log.remove(values['transaction_hash'])
+
+        with self.lock:
+            if self.log is not None:
+                self.log.rewrite(list(self.transactions.values()))
+        print(f'mempool reloaded, {admitted} of {len(transactions)} pending transactions are still valid')
+
+    def reconcile(self, salt, theirs):
+        """
+        answers a peer's /mempool/reconcile: our transactions it doesn't have, and the short ids it has that we don't
+        """
+        with self.lock:
+            missing, wanted = Reconcile.compare(salt, theirs, list(self.transactions))
+            return [self.transactions[transaction_hash] for transaction_hash in missing], wanted
+
+    def sync_from(self, neighbour):
+        """
+        fetches the transactions a peer has that we don't by sending it the short ids of ours,
+        then sends it back the ones it asked for. a peer without /mempool/reconcile sends its whole mempool instead.
+        everything received goes through the admission checks
+        :param neighbour: <str> Address of node. Eg. 'http://192.168.0.5:5000'
+        """
+        salt = Reconcile.new_salt()
+        with self.lock:
+            ours = {Reconcile.short_id(salt, transaction_hash): transaction_hash for transaction_hash in self.transactions}
+
+        try:
+            response = Peers.post(f'{neighbour}/mempool/reconcile', json=Reconcile.summary(ours.values(), salt))
+            if response.status_code == 404:
+                transactions, wanted = Peers.get(f'{neighbour}/mempool').json(), []
+            else:
+                values = response.json()
+                transactions, wanted = values['transactions'], Reconcile.unpack(values['wanted'])
+        except (requests.exceptions.RequestException, ValueError, KeyError, TypeError):
+            print(f'could not sync mempool with {neighbour}')
+            return
+
+        admitted = 0
+        for transaction in transactions:
+            if isinstance(transaction, dict):
+                message, status = self.admit_transaction(transaction, broadcast=False)
+                if status == 201:
+                    admitted += 1
+
+        with self.lock:
+            missing = [self.transactions[ours[short_id]] for short_id in wanted
+                       if short_id in ours and ours[short_id] in self.transactions]
+        if missing:
+            Broadcast.broadcast_transactions(missing, urlparse(neighbour).netloc)
+        print(f'mempool synced with {neighbour}: {admitted} new of {len(transactions)} received, {len(missing)} sent')
+
+    def compact_log(self):
+        with self.lock:
+            if self.log is not None and self.log.needs_compacting(len(self.transactions)):
+                self.log.rewrite(list(self.transactions.values()))
+
+    def stats(self):
+        return {
+            'transactions': len(self.transactions),
+            'bytes': self.total_bytes,
+            'pending_fees': self.pending_fees,
+            'max_count': self.max_count,
+            'max_bytes': self.max_bytes,
+            'block_max_bytes': self.block_max_bytes
+        }
+
+    @property
+    def current_transactions(self):
+        """
+        the pending transactions as a list in arrival order, the shape the routes and blocks have always used
+        """
+        with self.lock:
+            return list(self.transactions.values())
+
+    def add_transaction(self, transaction):
+        """
+        puts a transaction in the indexes, no checks are done here
+        """
+        transaction = TransactionRecord.compact(transaction)
+        transaction_hash = transaction.get('transaction_hash')
+        size = self.size_of(transaction)
+        with self.lock:
+            if transaction_hash in self.transactions:
+                self.remove_transaction(transaction_hash)
+            self.transactions[transaction_hash] = transaction
+            self.senders.setdefault(transaction.get('sender'), {})[transaction_hash] = None
+
+            self.sizes[transaction_hash] = size
+            self.total_bytes += size
+            self.pending_fees += self.fee_of(transaction)
+            self.pending_balances.add(transaction)
+
+            if self.log is not None:
+                self.log.add(transaction)
+
+            if self.prioritised:
+                self.arrivals += 1
+                heapq.heappush(self.heap, (self.fee_rate(transaction, size), self.arrivals, transaction_hash))
+                # stale entries pile up as blocks take transactions out, clear them out now and then
+                if len(self.heap) > 2 * len(self.transactions) + 1000:
+                    self.heap = [entry for entry in self.heap if entry[2] in self.transactions]
+                    heapq.heapify(self.heap)
+        return transaction
+
+    def remove_transaction(self, transaction_hash):
+        """
+        takes a transaction out of the mempool, returns it or None if it wasn't there
+        """
+        with self.lock:
+            transaction = self.transactions.pop(transaction_hash, None)
+            if transaction is not None:
+                pending = self.senders.get(transaction.get('sender'))
+                if pending is not None:
+                    pending.pop(transaction_hash, None)
+                    if not pending:
+                        del self.senders[transaction.get('sender')]
+
+                self.total_bytes -= self.sizes.pop(transaction_hash)
+                self.pending_fees -= self.fee_of(transaction)
+                self.pending_balances.remove(transaction)
+                # don't let rounding leave a few dust fees behind in an empty mempool
+                if not self.transactions:
+                    self.pending_fees = 0
+
+                if self.log is not None:
+                    self.log.remove(transaction_hash)
+            return transaction
+
+    def remove_transactions(self, transactions):
+        with self.lock:
+            for transaction in transactions:
+                self.remove_transaction(transaction.get('transaction_hash'))
+        self.compact_log()
+
+    def block_connected(self, block):
+        """
+        takes the transactions a new block confirmed out of the mempool. the rest stay, only the
+        senders the block spent from are checked again since nobody else's balance went down
+        """
+        with self.lock:
+            self.remove_transactions(block['transactions'])
+            self.recheck_senders({transaction.get('sender') for transaction in block['transactions']})
+
+    def overdrawn(self, address):
+        return self.pending_balances.balance(address) < -self.dust
+
+    def recheck_senders(self, senders):
+        """
+        makes sure each of these senders can still pay for everything they have pending. the newest transactions
+        of one that can't are dropped until they can, then the recipients of those are checked in turn
+        since they may have been spending coins that are no longer coming
+        """
+        with self.lock:
+            senders = list(senders)
+            while senders:
+                sender = senders.pop()
+                while sender in self.senders and self.overdrawn(sender):
+                    transaction_hash = next(reversed(self.senders[sender]))
+                    print(f'not enough funds for {transaction_hash} any more, removing it from the mempool')
+                    transaction = self.remove_transaction(transaction_hash)
+                    senders.append(transaction.get('recipient'))
+
+    def branch_switched(self, disconnected, connected):
+        """
+        after a reorg, the transactions of the blocks that were disconnected go back in the mempool
+        if they are still valid on the new branch. the new branch's blocks are handled like any new block first,
+        so anything they confirmed is turned away as already confirmed
+        """
+        for block in connected:
+            self.block_connected(block)
+
+        restored = 0
+        for block in disconnected:
+            for transaction in block['transactions']:
+                if transaction.get('sender') in ('Coinbase Reward', 'Transaction Fee Reward'):
+                    continue
+                message, status = self.admit_transaction(TransactionRecord.plain(transaction), broadcast=False)
+                if status == 201:
+                    restored += 1
+        if restored:
+            print(f'{restored} transactions from disconnected blocks are back in the mempool')
+
+        # the recipients of the disconnected blocks (rewards included) lost coins that were confirmed,
+        # whatever they have pending that spent them is dropped unless it came back above
+        self.recheck_senders({transaction.get('recipient') for block in disconnected
+                              for transaction in block['transactions']})
+
+    def make_room(self, transaction):
+        """
+        works out which of the lowest fee rate transactions have to be evicted to make room for a new one
+        when the mempool is full, nothing is taken out yet. returns their hashes, or None when that would mean
+        evicting something paying the same fee rate as the new transaction or more
+        """
+        if self.max_count is None and self.max_bytes is None:
+            return []
+
+        size = self.size_of(transaction)
+        rate = self.fee_rate(transaction, size)
+        with self.lock:
+            count = len(self.transactions) + 1
+            total = self.total_bytes + size
+
+            popped = []
+            evicted = []
+            while (self.max_count is not None and count > self.max_count) or \
+                    (self.max_bytes is not None and total > self.max_bytes):
+                if not self.heap:
+                    break
+                entry = heapq.heappop(self.heap)
+                if entry[2] not in self.transactions:
+                    continue
+                popped.append(entry)
+                if entry[0] >= rate:
+                    break
+                evicted.append(entry[2])
+                count -= 1
+                total -= self.sizes[entry[2]]
+
+            # the entries go back either way, evict() takes the transactions out and leaves their entries to go stale
+            for entry in popped:
+                heapq.heappush(self.heap, entry)
+
+            if (self.max_count is not None and count > self.max_count) or \
+                    (self.max_bytes is not None and total > self.max_bytes):
+                return None
+            return evicted
+
+    def eviction_balance(self, evicted, address):
+        """
+        what an address would have once the evicted transactions are gone, along with everything
+        evict() would take out after them because it was spending coins they paid out
+        """
+        with self.lock:
+            removed = set()
+            change = {}
+
+            def take(transaction_hash):
+                transaction = self.transactions[transaction_hash]
+                removed.add(transaction_hash)
+                amount = PendingBalances.number(transaction.get('amount'))
+                fee = PendingBalances.number(transaction.get('fee'))
+                change[transaction.get('recipient')] = change.get(transaction.get('recipient'), 0) - amount
+                change[transaction.get('sender')] = change.get(transaction.get('sender'), 0) + amount + fee
+                return transaction.get('recipient')
+
+            def balance(sender):
+                return self.pending_balances.balance(sender) + change.get(sender, 0)
+
+            # the same cascade as recheck_senders, newest first from each sender left overdrawn
+            senders = [take(transaction_hash) for transaction_hash in evicted]
+            while senders:
+                sender = senders.pop()
+                for transaction_hash in reversed(self.senders.get(sender, {})):
+                    if balance(sender) >= -self.dust:
+                        break
+                    if transaction_hash not in removed:
+                        senders.append(take(transaction_hash))
+            return balance(address)
+
+    def evict(self, evicted):
+        with self.lock:
+            recipients = set()
+            for transaction_hash in evicted:
+                print(f'mempool full, evicting {transaction_hash}')
+                recipients.add(self.remove_transaction(transaction_hash).get('recipient'))
+            # anything that was spending what the evicted transactions paid out has to go too
+            self.recheck_senders(recipients)
+
+    def block_template(self):
+        """
+        the transactions for the next block. in arrival order and all of them normally,
+        when prioritised the best fee rates first and no more than block_max_bytes.
+        a transaction can spend coins another pending transaction is paying to its sender, so it only goes in
+        once the transactions already picked cover it, after the ones it depends on
+        """
+        with self.lock:
+            if self.prioritised:
+                ranked = {}
+                for rate, arrival, transaction_hash in sorted(self.heap, key=lambda entry: (-entry[0], entry[1])):
+                    if transaction_hash in self.transactions:
+                        ranked.setdefault(transaction_hash)
+                ranked = list(ranked)
+            else:
+                ranked = list(self.transactions)
+
+            # balances with just the picked transactions applied
+            picked = PendingBalances(self.pending_balances.confirmed)
+            template = []
+            space = self.block_max_bytes
+            while ranked:
+                waiting = []
+                for transaction_hash in ranked:
+                    transaction = self.transactions[transaction_hash]
+                    size = self.sizes[transaction_hash]
+                    if space is not None and size > space:
+                        continue
+                    cost = PendingBalances.number(transaction.get('amount')) + self.fee_of(transaction)
+                    if picked.balance(transaction.get('sender')) - cost < -self.dust:
+                        waiting.append(transaction_hash)
+                        continue
+                    picked.add(transaction)
+                    template.append(transaction)
+                    if space is not None:
+                        space -= size
+                # go round again for the ones still waiting while picking more keeps paying for them
+                if len(waiting) == len(ranked):
+                    break
+                ranked = waiting
+            return template
+
+    def admit_transaction(self, values, signature_verified=None, broadcast=True):
+        """
+        runs the admission checks for a submitted transaction and adds it to the mempool if it passes.
+        each transaction is checked and added under the mempool lock, so it is either fully admitted or not at all.
+        signature_verified is the result of an earlier hash and signature check, None if it hasn't been done yet.
+        returns the (message, status code) to answer the submitter with
+        """
+        required = ['sender', 'recipient', 'amount', 'fee', 'time_submitted', 'previous_block_hash', 'public_key_hex',
+                    'transaction_hash', 'signature']
+
+        # Check that the required fields are in the POST'ed data
+        if not all(k in values for k in required):
+            print('Error 400: Transaction Malformed')
+            return 'Missing values', 400
+
+        with self.lock:
+            # Validates the public_key_hash also known as the address.
+            if not Hash_Validation.validate_pubkey_hash(pubkey=values['public_key_hex'], provided_pubkey_hash=values['sender']):
+                print('Error 480: provided address does not match locally hashed result of provided public key')
+                return "Error 490", 490
+
+            # Check if the sender is trying to send themselves coins to the same address, this is not allowed
+            if values['sender'] == values['recipient']:
+                return "You cant send a transaction to yourself", 430
+
+            # check if the minimum fee has been paid
+            if values['fee'] < .0005:
+                return "Please send transaction with minimum fee of .0005", 410
+
+            if self.transaction_in_pool(values):
+                return "Transaction already in mempool", 409
+
+            if blockchain.transactions.location(values['transaction_hash']) is not None:
+                return "Transaction already confirmed", 409
+
+            if signature_verified is False:
+                return "Transaction invalid", 400
+
+            # funds are checked against what the sender will have left after everything they already have pending
+            if not Transaction.verify_transaction(values=values, balances=self.pending_balances,
+                                                  signature_verified=signature_verified):
+                return "Transaction invalid", 400
+
+            evicted = self.make_room(values)
+            if evicted is None:
+                return "Mempool is full, please send transaction with a higher fee", 410
+
+            # evictions can take away pending coins the transaction was spending,
+            # so it is checked against what would be left before anything is evicted
+            if evicted and self.eviction_balance(evicted, values['sender']) < \
+                    values['amount'] + values['fee'] - self.dust:
+                return "Transaction invalid", 400
+            self.evict(evicted)
+
+            # Create a new Transaction in the mempool to await confirmation
+            trans_data = self.new_transaction(values['sender'], values['recipient'], values['amount'], values['fee'],
+                                              values['time_submitted'], values['previous_block_hash'],
+                                              values['public_key_hex'], values['transaction_hash'], values['signature'],
+                                              broadcast=False)
+
+        # passed on after the lock is released, a peer that sends it straight back to us mustn't find the mempool locked
+        if broadcast:
+            self.broadcast_transaction(trans_data)
+        return "ok", 201
 
     def transaction_in_pool(self, transaction):
-        if transaction in self.current_transactions:
+        if transaction.get('transaction_hash') in self.transactions:
             return True
         return False
 
     def new_transaction(self, sender, recipient, amount, fee, unix_time, previous_block_hash, pub_key_hex, trans_hash,
-                        signature):
-        trans_data = {
+                        signature, broadcast=True):
+        trans_data = TransactionRecord({
             'sender': sender,
             'recipient': recipient,
             'amount': amount,
@@ -228,21 +808,17 @@ class Mempool:
             'public_key_hex': pub_key_hex,
             'transaction_hash': trans_hash,
             'signature': signature
-        }
+        })
 
-        if sender == "Coinbase Reward" or sender == "Transaction Fee Reward":
-            self.current_transactions.append(trans_data)
-
-        else:
-            self.current_transactions.append(trans_data)
-            nodes = node.nodes
-            for neighbour in nodes:
-                if Broadcast.broadcast_transaction(trans_data, neighbour):
-                    print("Transaction Broadcast accepted")
+        self.add_transaction(trans_data)
+        if sender != "Coinbase Reward" and sender != "Transaction Fee Reward" and broadcast:
+            self.broadcast_transaction(trans_data)
+        return trans_data
 
-                else:
-                    pass
-        return True
+    @staticmethod
+    def broadcast_transaction(trans_data):
+        # announced to every node in the background, together with any others admitted around the same time
+        Broadcast.queue_transactions([trans_data], Node.announce_transactions)
 
     def new_coinbase_transaction(self, values):
         confirming_address = values['public_key_hash']
@@ -278,24 +854,18 @@ class Mempool:
 
         # We must receive a reward for finding the proof.
         # The sender is "Coinbase" to signify a new block reward has been mined.
-        self.new_transaction(full_block_reward_transaction['sender'],
-                             full_block_reward_transaction['recipient'],
-                             full_block_reward_transaction['amount'],
-                             full_block_reward_transaction['fee'],
-                             full_block_reward_transaction['time_submitted'],
-                             full_block_reward_transaction['previous_block_hash'],
-                             full_block_reward_transaction['public_key_hex'],
-                             full_block_reward_transaction['transaction_hash'],
-                             full_block_reward_transaction['signature'])
+        return TransactionRecord(full_block_reward_transaction)
 
     @staticmethod
-    def new_fee_reward_transaction(values):
+    def new_fee_reward_transaction(values, fees):
+        """
+        the transaction paying the fees of the transactions in a block to its miner, None if there are no fees
+        """
         confirming_address = values['public_key_hash']
         public_key_hex = values['public_key_hex']
         previous_hash = values['previous_block_hash']
         signature = values['signature']
         unix_time = time()
-        fees = mp.pending_fees
         if fees > 0:
             fee_reward_trans = {
                 'sender': 'Transaction Fee Reward',
@@ -322,22 +892,17 @@ class Mempool:
                 'transaction_hash': hashed_fees
             }
 
-            mp.new_transaction(fee_reward_trans_with_hash['sender'],
-                               fee_reward_trans_with_hash['recipient'],
-                               fee_reward_trans_with_hash['amount'],
-                               fee_reward_trans_with_hash['fee'],
-                               fee_reward_trans_with_hash['time_submitted'],
-                               fee_reward_trans_with_hash['previous_block_hash'],
-                               fee_reward_trans_with_hash['public_key_hex'],
-                               fee_reward_trans_with_hash['transaction_hash'],
-                               fee_reward_trans_with_hash['signature'])
-            mp.pending_fees = 0
+            return TransactionRecord(fee_reward_trans_with_hash)
+        return None
 
 
 class Node:
     # set for storing nodes
     nodes = set()
 
+    # number of blocks requested per page when downloading a branch
+    page_size = 500
+
     def __init__(self):
 
 
@@ -373,66 +938,256 @@ class Node:
         """
 
         parsed_url = urlparse(address)
-        Node.nodes.remove(parsed_url.netloc)
+        Node.nodes.discard(parsed_url.netloc)
+
+    @staticmethod
+    def block_locator():
+        """
+        hashes of our blocks walking back from the tip, one by one for the last 10 blocks
+        and then doubling the step each time, always finishing with the genesis block.
+        lets a peer find where our chains split in a single request.
+        """
+        locator = []
+        height = len(blockchain.chain) - 1
+        step = 1
+        while height > 0:
+            locator.append(blockchain.store.entry(height)[3].hex())
+            if len(locator) >= 10:
+                step *= 2
+            height -= step
+        locator.append(blockchain.store.entry(0)[3].hex())
+        return locator
+
+    @staticmethod
+    def fetch_branch(neighbour):
+        """
+        asks a neighbour where its chain forks from ours and downloads only the blocks after that point.
+        returns (fork height, blocks after the fork, their chain length) or None.
+        """
+        response = Peers.post(f'http://{neighbour}/chain/fork', json={'locator': Node.block_locator()})
+
+        # nodes running older versions only have /chain
+        if response.status_code == 404:
+            return Node.fetch_full_chain(neighbour)
+
+        if response.status_code != 200:
+            return None
+
+        fork = response.json()['height']
+        length = response.json()['length']
+
+        # ask for the compact binary encoding, peers that can't encode a page send json instead
+        headers = {'Accept': f'{Codec.CONTENT_TYPE}, application/json'}
+        blocks = []
+        while fork + 1 + len(blocks) < length:
+            page = Peers.get(f'http://{neighbour}/chain/blocks', headers=headers,
+                                params={'start': fork + 1 + len(blocks), 'limit': Node.page_size})
+            if page.status_code != 200:
+                return None
+
+            if page.headers.get('Content-Type', '').startswith(Codec.CONTENT_TYPE):
+                page_blocks = Codec.decode_blocks(page.content)
+            else:
+                page_blocks = page.json()['blocks']
+
+            if not page_blocks:
+                return None
+            blocks.extend(page_blocks)
+
+        return fork, blocks, length
+
+    @staticmethod
+    def fetch_full_chain(neighbour):
+        """
+        fallback for old peers, downloads their whole chain and works out the fork point locally
+        """
+        response = Peers.get(f'http://{neighbour}/chain')
+        if response.status_code != 200:
+            return None
+
+        chain = response.json()['chain']
+        fork = -1
+        while fork + 1 < min(len(chain), len(blockchain.chain)):
+            if blockchain.store.entry(fork + 1)[3] != BlockStore.hash_key(chain[fork + 1]['current_hash']):
+                break
+            fork += 1
+
+        return fork, chain[fork + 1:], len(chain)
+
+    @staticmethod
+    def links_to_chain(fork, blocks):
+        """
+        True if a branch forks at a height we actually have and its first block follows on from ours there,
+        a fork of -1 replaces the whole chain
+        """
+        if isinstance(fork, bool) or not isinstance(fork, int) or not -1 <= fork < len(blockchain.chain):
+            return False
+        if not blocks or not isinstance(blocks[0], (dict, BlockRecord)):
+            return False
+        if fork >= 0:
+            return blocks[0].get('previous_hash') == blockchain.chain[fork]['current_hash']
+        return True
 
     @staticmethod
     def resolve_conflicts():
         """
         This is our Consensus Algorithm, it resolves conflicts
         by replacing our chain with the longest one in the network.
+        Only the blocks after the point where our chains split are downloaded and validated.
         :return: <bool> True if our chain was replaced, False if not
         """
 
-        neighbours = Node.nodes
-        new_chain = None
+        # a copy, nodes can be removed by broadcasts finishing on other threads
+        neighbours = list(Node.nodes)
+        best = None
 
         # We're only looking for chains longer than ours
         max_length = len(blockchain.chain)
 
-        # Grab and verify the chains from all the nodes in our network
+        # Grab and verify the branches from all the nodes in our network
         for neighbour in neighbours:
-            response = requests.get(f'http://{neighbour}/chain')
-
-            if response.status_code == 200:
-                length = response.json()['length']
-                chain = response.json()['chain']
+            # a node that can't be reached or sends something broken is skipped, the others are still checked
+            try:
+                branch = Node.fetch_branch(neighbour)
+                if branch is None:
+                    continue
+
+                fork, blocks, length = branch
+                if length <= max_length or not Node.links_to_chain(fork, blocks) or fork + 1 + len(blocks) != length:
+                    continue
+
+                # our blocks up to the fork are already validated, so the branch
+                # only needs checking from the last block we have in common
+                if fork >= 0:
+                    valid = ValidChain.valid_chain_parallel([blockchain.chain[fork]] + blocks)
+                else:
+                    valid = ValidChain.valid_chain_parallel(blocks)
+            except (requests.exceptions.RequestException, CodecError, KeyError, ValueError, TypeError,
+                    AttributeError, IndexError) as e:
+                print(f'could not get a branch from {neighbour}: {e!r}')
+                continue
 
-                # Check if the length is longer and the chain is valid
-                if length > max_length and ValidChain.valid_chain(chain):
-                    max_length = length
-                    new_chain = chain
+            if valid:
+                max_length = length
+                best = (fork, blocks)
 
         # Replace our chain if we discovered a new, valid chain longer than ours
-        if new_chain:
-            blockchain.chain = new_chain
-
-            print("chain updated")
+        if best:
+            fork, blocks = best
+            with blockchain.lock:
+                # the branches were fetched without the lock, make sure the chain hasn't moved past this one since
+                if max_length <= len(blockchain.chain) or not Node.links_to_chain(fork, blocks):
+                    return False
 
-            if os.path.exists('data/chain.json'):
-                os.remove('data/chain.json')
-                print("old chain removed, now writing new chain")
-            else:
-                print("no chain data found... Creating it now.")
+                blockchain.switch_branch(fork, blocks)
+                print(f"chain updated, {len(blocks)} new blocks connected from block {fork + 2}")
 
-            with open('data/chain.json', 'w') as f:
-                for i in blockchain.chain:
-                    string = json.dumps(i)
-                    f.write(string)
-                    f.write('\n')
+                # the new branch was just validated
+                blockchain.save_checkpoint()
 
             return True
 
         return False
 
+    @staticmethod
+    def inventory(blocks=(), transactions=()):
+        """
+        what Broadcast.announce offers to other nodes, the port is so they know where to fetch the bodies from.
+        the json of the blocks is built here once, for every node that has them pushed instead
+        """
+        blocks = list(blocks)
+        return {'port': blockchain.port, 'blocks': blocks, 'transactions': list(transactions),
+                'block_bytes': [BlockRecord.wrap(block).json_bytes() for block in blocks]}
+
+    @staticmethod
+    def wanted(block_hashes, transaction_hashes):
+        """
+        the announced block and transaction hashes we don't have yet
+        """
+        blocks = [h for h in block_hashes if blockchain.store.height_of(h) is None]
+        transactions = [h for h in transaction_hashes
+                        if h not in mp.transactions and blockchain.transactions.location(h) is None]
+        return blocks, transactions
+
+    @staticmethod
+    def announce_transactions(transactions):
+        """
+        offers a batch of transactions to every node, on the broadcast lane kept for transactions
+        """
+        Broadcast.fan_out(Broadcast.announce, Node.inventory(transactions=transactions), node.nodes,
+                          lane='transactions')
+
+    @staticmethod
+    def block_broadcast_done(results):
+        """
+        called once a block has been sent to every node. nodes that timed out or didn't answer are removed,
+        one whose send never ran is kept. if any node rejected the block we resolve our chain
+        """
+        for neighbour, status in results.items():
+            if status == "TimeoutError":
+                Node.remove_node("http://" + neighbour)
+
+        if any(status is False for status in results.values()):
+            Node.resolve_conflicts()
+
+
+parser = argparse.ArgumentParser(description='python-blockchain node')
+parser.add_argument('--full-verify', action='store_true',
+                    help='validate the whole local chain on startup instead of resuming from the last checkpoint')
+parser.add_argument('--fsync-every', type=int, default=1,
+                    help='fsync the block store after this many blocks (group commit)')
+parser.add_argument('--fsync-interval', type=int, default=0,
+                    help='fsync the block store once unsynced blocks are this many milliseconds old, 0 to disable')
+parser.add_argument('--validation-workers', type=int, default=None,
+                    help='number of worker processes used to validate the chain and batches of signatures, '
+                         'defaults to one per core')
+parser.add_argument('--mempool-max-count', type=int, default=None,
+                    help='most transactions kept in the mempool, the lowest fee per byte is evicted first')
+parser.add_argument('--mempool-max-bytes', type=int, default=None,
+                    help='most encoded transaction bytes kept in the mempool, the lowest fee per byte is evicted first')
+parser.add_argument('--block-max-bytes', type=int, default=None,
+                    help='most transaction bytes put in a block we mine, the highest fee per byte goes in first')
+parser.add_argument('--peer-connect-timeout', type=float, default=Peers.connect_timeout,
+                    help='seconds to wait for a connection to another node')
+parser.add_argument('--peer-read-timeout', type=float, default=Peers.read_timeout,
+                    help='seconds to wait for another node to answer once connected')
+parser.add_argument('--peer-retries', type=int, default=Peers.retries,
+                    help='times a failed request to another node is retried, with backoff')
+parser.add_argument('--broadcast-deadline', type=float, default=Broadcast.deadline,
+                    help='seconds each node gets to answer a broadcast, from when its request starts, '
+                         'before it is dropped as unresponsive')
+args = parser.parse_args()
+
+# the worker processes are forked first, while this is still the only thread
+Workers.start(args.validation_workers)
+
+# every request to other nodes shares one pool of keep-alive connections
+Peers.configure(connect_timeout=args.peer_connect_timeout, read_timeout=args.peer_read_timeout,
+                retries=args.peer_retries)
+# blocks and transactions are sent to every node at once
+Broadcast.deadline = args.broadcast_deadline
 
 # Instantiate the Node
 app = Flask(__name__)
 
 # Instantiate the Blockchain, Node and Mempool classes
-mp = Mempool()
-blockchain = Blockchain()
+mp = Mempool(max_count=args.mempool_max_count, max_bytes=args.mempool_max_bytes,
+             block_max_bytes=args.block_max_bytes)
+blockchain = Blockchain(full_verify=args.full_verify, fsync_every=args.fsync_every,
+                        fsync_interval=args.fsync_interval)
+
+# admission checks funds against the confirmed balances with the mempool on top.
+# attached before Node() since it can already switch branch and put transactions back in the mempool
+mp.pending_balances.confirmed = blockchain.balances
+
 node = Node()
 
+# pending transactions from before the restart go back in once they've been checked against the current tip
+reloaded_transactions = mp.open_log('data/mempool.dat')
+if reloaded_transactions:
+    print(f'revalidating {len(reloaded_transactions)} pending transactions from the last run')
+    threading.Thread(target=mp.revalidate, args=(reloaded_transactions,), daemon=True).start()
+
 
 # Unique address on the chain is a 2 part hash of our public key
 node_identifier = blockchain.public_key_hash
@@ -443,9 +1198,40 @@ def difficulty():
     return jsonify(blockchain.difficulty)
 
 
+@app.route('/stats', methods=['GET'])
+def stats():
+    response = {
+        'signature_cache': Signature.verified.stats(),
+        'public_key_cache': PublicKeys.cache.stats(),
+        'block_cache': blockchain.chain.cache.stats(),
+        'stored_public_keys': len(blockchain.store.keys),
+        'mempool': mp.stats()
+    }
+    return jsonify(response), 200
+
+
 @app.route('/mempool', methods=['GET'])
 def mempool():
-    return jsonify(mp.current_transactions), 200
+    return jsonify([TransactionRecord.plain(t) for t in mp.current_transactions]), 200
+
+
+@app.route('/mempool/reconcile', methods=['POST'])
+def reconcile_mempool():
+    """
+    takes the short ids of the transactions a peer has, see src/reconcile.py.
+    returns the transactions it is missing and the short ids of its transactions we don't have
+    """
+    try:
+        salt, theirs = Reconcile.read_summary(request.get_json(silent=True))
+    except ValueError:
+        return 'Error: Please supply a salt and packed short_ids', 400
+
+    missing, wanted = mp.reconcile(salt, theirs)
+    response = {
+        'transactions': [TransactionRecord.plain(t) for t in missing],
+        'wanted': Reconcile.pack(wanted)
+    }
+    return jsonify(response), 200
 
 
 @app.route('/proof', methods=['GET'])
@@ -458,118 +1244,265 @@ def last_proof():
 @app.route('/chain', methods=['GET'])
 def full_chain():
     response = {
-        'chain': blockchain.chain,
+        'chain': [BlockRecord.plain(block) for block in blockchain.chain],
         'length': len(blockchain.chain),
     }
     return jsonify(response), 200
 
 
-@app.route('/transactions/new', methods=['POST'])
-def new_transaction():
+@app.route('/balance/<address>', methods=['GET'])
+def balance(address):
+    response = {
+        'address': address,
+        'balance': blockchain.balances.balance(address),
+        'pending_balance': mp.pending_balances.balance(address),
+        'height': len(blockchain.chain)
+    }
+    return jsonify(response), 200
+
+
+@app.route('/address/<address>/transactions', methods=['GET'])
+def address_transactions(address):
+    cursor = request.args.get('cursor', None, type=int)
+    limit = min(max(request.args.get('limit', 50, type=int), 1), 500)
+
+    entries, next_cursor = blockchain.addresses.history(address, cursor=cursor, limit=limit)
+
+    transactions = []
+    for height, position in entries:
+        block = blockchain.chain[height]
+        transactions.append({
+            'block_index': block['index'],
+            'block_hash': block['current_hash'],
+            'transaction': TransactionRecord.plain(block['transactions'][position])
+        })
+
+    response = {
+        'address': address,
+        'transactions': transactions,
+        'next_cursor': next_cursor
+    }
+    return jsonify(response), 200
+
+
+@app.route('/chain/fork', methods=['POST'])
+def chain_fork():
     values = request.get_json()
+    locator = values.get('locator')
+    if locator is None:
+        return "Error: Please supply a block locator", 400
+
+    # the first locator hash we recognise is the last block our chains have in common
+    height = -1
+    for block_hash in locator:
+        found = blockchain.store.height_of(block_hash)
+        if found is not None:
+            height = found
+            break
+
+    response = {
+        'height': height,
+        'length': len(blockchain.chain)
+    }
+    return jsonify(response), 200
+
+
+@app.route('/chain/blocks', methods=['GET'])
+def chain_blocks():
+    start = request.args.get('start', 0, type=int)
+    limit = min(request.args.get('limit', Node.page_size, type=int), Node.page_size)
+    blocks = [BlockRecord.plain(block) for block in blockchain.chain[start:start + limit]]
+
+    if Codec.CONTENT_TYPE in request.headers.get('Accept', ''):
+        try:
+            return Response(Codec.encode_blocks(blocks), mimetype=Codec.CONTENT_TYPE), 200
+        except CodecError:
+            pass
+
+    response = {
+        'blocks': blocks,
+        'length': len(blockchain.chain)
+    }
+    return jsonify(response), 200
 
-    required = ['sender', 'recipient', 'amount', 'fee', 'time_submitted', 'previous_block_hash', 'public_key_hex',
-                'transaction_hash', 'signature']
 
-    # Check that the required fields are in the POST'ed data
-    if not all(k in values for k in required):
+@app.route('/transactions/new', methods=['POST'])
+def new_transaction():
+    values = request.get_json()
+    if not isinstance(values, dict):
         print('Error 400: Transaction Malformed')
         return 'Missing values', 400
+    return mp.admit_transaction(values)
 
-        # Check if this address already has a transaction in the chain
-    for transaction in mp.current_transactions:
-        if transaction['sender'] == values['sender']:
-            print('Error 420: One Transaction per Block')
-            return 'One Transaction per block, wait for next block confirmation', 420
 
-        # Validates the public_key_hash also known as the address.
-    if not Hash_Validation.validate_pubkey_hash(pubkey=values['public_key_hex'], provided_pubkey_hash=values['sender']):
-        print('Error 480: provided address does not match locally hashed result of provided public key')
-        return "Error 490", 490
+@app.route('/transactions/batch', methods=['POST'])
+def new_transactions_batch():
+    values = request.get_json()
+    if not isinstance(values, list):
+        return "Error: Please supply a list of transactions", 400
+    if len(values) > Mempool.batch_limit:
+        return f"Error: At most {Mempool.batch_limit} transactions per batch", 413
+
+    # the hash and signature checks don't depend on the chain or the mempool,
+    # so they all run up front in parallel and only the admission below is done one at a time
+    signatures = Transaction.verify_signatures_parallel(values)
+
+    results = []
+    accepted = []
+    for transaction, signature_valid in zip(values, signatures):
+        if isinstance(transaction, dict):
+            message, status = mp.admit_transaction(transaction, signature_verified=signature_valid, broadcast=False)
+            transaction_hash = transaction.get('transaction_hash')
+        else:
+            message, status = 'Missing values', 400
+            transaction_hash = None
 
-        # Check if the sender is trying to send themselves coins to the same address, this is not allowed
-    if values['sender'] == values['recipient']:
-        return "You cant send a transaction to yourself", 430
+        if status == 201:
+            accepted.append(transaction)
+        results.append({'transaction_hash': transaction_hash, 'status': status, 'message': message})
 
-        # check if the minimum fee has been paid
-    if values['fee'] < .0005:
-        return "Please send transaction with minimum fee of .0005", 410
+    # pass the accepted ones on to our peers as one batch instead of one request per transaction
+    if accepted:
+        Broadcast.queue_transactions(accepted, Node.announce_transactions)
 
-    if not mp.transaction_in_pool(values):
-        if Transaction.verify_transaction(values=values, chain=blockchain.chain):
-            # Create a new Transaction in the mempool to await confirmation
-            if mp.new_transaction(values['sender'], values['recipient'], values['amount'],
-                                  values['fee'],
-                                  values['time_submitted'], values['previous_block_hash'],
-                                  values['public_key_hex'], values['transaction_hash'],
-                                  values['signature']):
-                mp.pending_fees += values['fee']
-                return "ok", 201
+    response = {
+        'accepted': len(accepted),
+        'rejected': len(values) - len(accepted),
+        'results': results
+    }
+    return jsonify(response), 200
 
 
-@app.route('/broadcast', methods=['POST'])
-def receive_block():
+@app.route('/transactions/<transaction_hash>', methods=['GET'])
+def get_transaction(transaction_hash):
+    found = blockchain.find_transaction(transaction_hash)
+    if found is None:
+        return "Transaction not found", 404
+    return jsonify(found), 200
+
+
+@app.route('/transactions/lookup', methods=['POST'])
+def lookup_transactions():
     values = request.get_json()
-    # check all the block info has been submitted
-    required = ['index', 'timestamp', 'transactions', 'difficulty', 'proof', 'previous_hash', 'current_hash']
-    if not all(k in values for k in required):
-        # if not we return an error so the sending node can do something
-        return "block broadcast denied", 400
-
-    # if all goes as planned we continue
-    index = values['index']
-    last_proof = blockchain.last_proof
-    last_block_index = blockchain.last_block['index']
-
-    if not index - last_block_index == 1:
-        print('blocks out of order... resolving')
-        Node.resolve_conflicts()
-        return "out of order", 400
-
-
-
-    # call function to validate block
-    if ValidBlock.validate_received_block(values, last_proof, blockchain.difficulty):
-        # if valid we append it to the local chain
-        Write.write_chain(values)
-        blockchain.chain.append(values)
-        # and clear the mempool
-        mp.clear_mempool()
-        mp.clear_fees()
-        # check to see if the block index is the beginning of a new epoch to do difficulty calculations
-        if index % 100 == 0:
-            blockchain.check_epoch_time()
-
-        # list for storing the failed nodes
-        failed_nodes = []
-        prefix = "http://"
-
-        # iterate through nodes to broadcast the new block
-        for neighbour in node.nodes:
-            # Broadcast the block to the registered nodes
-            broadcast_status = Broadcast.broadcast_block(block=values, node=neighbour)
-
-            # if a node times out or doesnt return a response we will add it to the failed nodes list
-            if broadcast_status == "TimeoutError":
-                failed_nodes.append(neighbour)
-
-
-            # if the broadcast is rejected we will resolve our chain.
-            if not broadcast_status:
-                Node.resolve_conflicts()
-
-            # if the length of the failed node list is greater than zero
-            # we iterate through the list and remove those nodes.
-            if len(failed_nodes) > 0:
-                for neighbour in failed_nodes:
-                    address = prefix + neighbour
-                    Node.remove_node(address)
+    hashes = values.get('hashes') if values else None
+    if not isinstance(hashes, list):
+        return "Error: Please supply a list of transaction hashes", 400
+    if len(hashes) > 10000:
+        return "Error: At most 10000 hashes per lookup", 413
+
+    found = {}
+    missing = []
+    for transaction_hash in hashes:
+        result = blockchain.find_transaction(transaction_hash)
+        if result is None:
+            missing.append(transaction_hash)
+        else:
+            found[transaction_hash] = result
 
-        return "ok", 200
+    response = {
+        'found': found,
+        'missing': missing
+    }
+    return jsonify(response), 200
+
+
+@app.route('/broadcast', methods=['POST'])
+def receive_block():
+    # blocks can be sent in the binary encoding or as json
+    if request.mimetype == Codec.CONTENT_TYPE:
+        try:
+            values = Codec.decode_block(request.get_data())
+        except CodecError:
+            return "block broadcast denied", 400
     else:
-        Node.resolve_conflicts()
-    # if the function returns False the block is denied.
-        return "block broadcast denied", 400
+        values = request.get_json()
+    return Block.receive_block(values)
+
+
+@app.route('/inv', methods=['POST'])
+def receive_inventory():
+    """
+    another node announcing the hashes of new blocks and transactions. the ones we don't have are fetched
+    from its /getdata and handled as if they had been sent to /broadcast and /transactions/new.
+    answers whether every block was accepted, so the announcing node can resolve if not
+    """
+    values = request.get_json(silent=True)
+    if not isinstance(values, dict) or 'port' not in values:
+        return 'Error: Please supply the port to fetch from and lists of block and transaction hashes', 400
+    # only ever a port number, it goes into the url we fetch from
+    port = values['port']
+    if isinstance(port, str) and port.isdigit() and port.isascii():
+        port = int(port)
+    if isinstance(port, bool) or not isinstance(port, int) or not 1 <= port <= 65535:
+        return 'Error: Please supply a valid port', 400
+    block_hashes = values.get('blocks', [])
+    transaction_hashes = values.get('transactions', [])
+    if not isinstance(block_hashes, list) or not isinstance(transaction_hashes, list) \
+            or not all(isinstance(h, str) for h in block_hashes + transaction_hashes):
+        return 'Error: Please supply lists of block and transaction hashes', 400
+    if len(block_hashes) + len(transaction_hashes) > Mempool.batch_limit:
+        return f'Error: No more than {Mempool.batch_limit} hashes per announcement', 413
+
+    wanted_blocks, wanted_transactions = Node.wanted(block_hashes, transaction_hashes)
+    if not wanted_blocks and not wanted_transactions:
+        return jsonify({'accepted': True}), 200
+
+    host = request.remote_addr
+    if ':' in host:
+        host = f'[{host}]'
+    try:
+        response = Peers.post(f'http://{host}:{port}/getdata',
+                              json={'blocks': wanted_blocks, 'transactions': wanted_transactions})
+        data = response.json()
+    except (requests.exceptions.RequestException, ValueError):
+        # the announcing node pushes the bodies to us instead
+        return 'Error: Could not fetch the announced data', 502
+
+    accepted = True
+    for block in data.get('blocks', []):
+        message, status = Block.receive_block(block)
+        if status != 200:
+            accepted = False
+
+    for transaction in data.get('transactions', []):
+        if isinstance(transaction, dict):
+            mp.admit_transaction(transaction)
+
+    return jsonify({'accepted': accepted}), 200
+
+
+@app.route('/getdata', methods=['POST'])
+def send_data():
+    """
+    the bodies of blocks and transactions by hash, for a node we announced them to.
+    transactions come from the mempool or the chain, anything we don't have is left out
+    """
+    values = request.get_json(silent=True)
+    if not isinstance(values, dict):
+        return 'Error: Please supply lists of block and transaction hashes', 400
+    block_hashes = values.get('blocks', [])
+    transaction_hashes = values.get('transactions', [])
+    if not isinstance(block_hashes, list) or not isinstance(transaction_hashes, list):
+        return 'Error: Please supply lists of block and transaction hashes', 400
+    if len(block_hashes) + len(transaction_hashes) > Mempool.batch_limit:
+        return f'Error: No more than {Mempool.batch_limit} hashes per request', 413
+
+    blocks = []
+    for block_hash in block_hashes:
+        block = blockchain.store.get_by_hash(block_hash)
+        if block is not None:
+            blocks.append(BlockRecord.plain(block))
+
+    transactions = []
+    for transaction_hash in transaction_hashes:
+        transaction = mp.transactions.get(transaction_hash)
+        if transaction is None:
+            found = blockchain.find_transaction(transaction_hash)
+            transaction = found['transaction'] if found is not None else None
+        if transaction is not None:
+            transactions.append(TransactionRecord.plain(transaction))
+
+    return jsonify({'blocks': blocks, 'transactions': transactions}), 200
 
 
 @app.route('/miners', methods=['POST'])
@@ -579,19 +1512,29 @@ def receive_proof():
     unix_time = time()
 
     submitted_last_proof = values['last_proof']
-    last_proof = blockchain.last_block['proof']
-
-    if submitted_last_proof == last_proof:
-        if Transaction.verify_proof_transaction(values=values, last_proof=last_proof, difficulty=blockchain.difficulty):
-            proof = values['proof']
-            previous_block_hash = values['previous_block_hash']
-            mp.new_coinbase_transaction(values=values)
-            if mp.pending_fees > 0:
-                mp.new_fee_reward_transaction(values=values)
-            Block.new_block(proof=proof, time=unix_time, mempool=mp.current_transactions,
-                            previous_hash=previous_block_hash)
-            mp.clear_mempool()
-            return "proof accepted", 200
+
+    # held until the block is added, a block arriving from a peer meanwhile would make this proof stale
+    with blockchain.lock:
+        last_proof = blockchain.last_block['proof']
+
+        if submitted_last_proof == last_proof:
+            if Transaction.verify_proof_transaction(values=values, last_proof=last_proof,
+                                                    difficulty=blockchain.difficulty):
+                proof = values['proof']
+                previous_block_hash = values['previous_block_hash']
+
+                # the block gets the mempool's pick of transactions and the rewards for them,
+                # they leave the mempool when the block is added and anything left out waits for the next block
+                template = mp.block_template()
+                fees = sum(Mempool.fee_of(transaction) for transaction in template)
+                transactions = template + [mp.new_coinbase_transaction(values=values)]
+                fee_reward = mp.new_fee_reward_transaction(values=values, fees=fees)
+                if fee_reward is not None:
+                    transactions.append(fee_reward)
+
+                Block.new_block(proof=proof, time=unix_time, mempool=transactions,
+                                previous_hash=previous_block_hash)
+                return "proof accepted", 200
     return "stale proof", 400
 
 
@@ -608,21 +1551,17 @@ def register_nodes():
 
     for neighbour in nodes:
         node.register_node(neighbour)
-        mempool_resp = requests.get(f'{neighbour}/mempool')
-        current_mempool = mempool_resp.json()
-        mp.current_transactions = current_mempool
         blockchain.difficulty = Epoch.get_difficulty(neighbour)
 
-    mp.pending_fees = 0
+    node.resolve_conflicts()
 
-    for transaction in mp.current_transactions:
-        mp.pending_fees += transaction['fee']
+    # mempools are synced against the resolved chain, so transactions paid for by blocks we just got are accepted
+    for neighbour in nodes:
+        mp.sync_from(neighbour)
 
-    print(f'got mempool:\n{mp.current_transactions}')
+    print(f'mempool: {len(mp)} transactions')
     print(f'pending fees: {mp.pending_fees}')
 
-    node.resolve_conflicts()
-
     response = {
         'message': 'New nodes have been added',
         'total_nodes': list(node.nodes),
@@ -637,12 +1576,12 @@ def consensus():
     if replaced:
         response = {
             'message': 'Our chain was replaced',
-            'new_chain': blockchain.chain
+            'new_chain': [BlockRecord.plain(block) for block in blockchain.chain]
         }
     else:
         response = {
             'message': 'Our chain is authoritative',
-            'chain': blockchain.chain
+            'chain': [BlockRecord.plain(block) for block in blockchain.chain]
         }
 
     return jsonify(response), 200
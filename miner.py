@@ -1,10 +1,10 @@
 import hashlib
 import time
 import binascii
-import requests
 import os
 import json
 from src.utils import Generate
+from src.peers import Peers
 from Crypto.PublicKey import RSA
 import random
 from Crypto.Signature import pkcs1_15
@@ -59,13 +59,13 @@ class Miner:
         return guess_hash[:Miner.difficulty] == valid_guess
 
     def get_difficulty(self):
-        value = requests.get(f'http://{self.node}/difficulty')
+        value = Peers.get(f'http://{self.node}/difficulty')
         if value.status_code == 200:
             return value.json()
 
     def get_last_block(self):
 
-        response = requests.get(f'http://{self.node}/chain')
+        response = Peers.get(f'http://{self.node}/chain')
 
         if response.status_code == 200:
             length = response.json()['length']
@@ -74,7 +74,7 @@ class Miner:
             return chain[length - 1]
 
     def get_last_proof(self):
-        response = requests.get(f'http://{self.node}/proof')
+        response = Peers.get(f'http://{self.node}/proof')
         if response.status_code == 200:
             return response.json()
         else:
@@ -149,7 +149,7 @@ class Miner:
                         'signature': proof_signature
                     }
 
-                    response = requests.post(f'http://{self.node}/miners', json=proof_transaction_with_sig,
+                    response = Peers.post(f'http://{self.node}/miners', json=proof_transaction_with_sig,
                                              headers=headers)
 
                     if response.status_code == 200:
@@ -174,7 +174,7 @@ class Miner:
             difficulty = self.difficulty
             last_proof = self.get_last_proof()
             print(f'Last Proof: {last_proof}\nDifficulty: {self.difficulty}')
-            job_request = requests.get(f'http://{self.node}/getjob')
+            job_request = Peers.get(f'http://{self.node}/getjob')
             job = job_request.json()
             lower_limit = job['lower']
             upper_limit = job['upper']
@@ -200,7 +200,7 @@ class Miner:
                 if self.valid_proof(last_proof, proof):
                     print('Proof Found: ', proof)
                     headers = {'Content-type': 'application/json', 'Accept': 'text/plain'}
-                    requests.post(f'http://{self.node}/submit', json=shares)
+                    Peers.post(f'http://{self.node}/submit', json=shares)
                     shares = []
                     proof_transaction = {
                         'proof': proof,
@@ -221,7 +221,7 @@ class Miner:
                         'signature': proof_signature
                     }
 
-                    response = requests.post(f'http://{self.node}/submit/proof', json=proof_transaction_with_sig,
+                    response = Peers.post(f'http://{self.node}/submit/proof', json=proof_transaction_with_sig,
                                              headers=headers)
 
                     if response.status_code == 200:
@@ -236,7 +236,7 @@ class Miner:
 
 
             if len(shares) > 1:
-                requests.post(f'http://{self.node}/submit', json=shares)
+                Peers.post(f'http://{self.node}/submit', json=shares)
                 print("finished processing job, now sharing with pool")
 
                 # clear the list storing our generated shares after sharing them
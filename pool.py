@@ -5,12 +5,12 @@ import json
 from time import time
 from tqdm import tqdm
 import os
-import requests
 from Crypto.Signature import pkcs1_15
 from flask import Flask, jsonify, request
 from Crypto.Hash import SHA256
 from Crypto.PublicKey import RSA
 from src.utils import Generate
+from src.peers import Peers
 import logging
 from src.validation import Signature
 from multiprocessing import Process
@@ -58,12 +58,12 @@ class pool:
 
     # functions to get different chain data from the blockchain
     def get_chain(self):
-        response = requests.get(f'http://{self.node_address}/chain')
+        response = Peers.get(f'http://{self.node_address}/chain')
         if response.status_code == 200:
             return response.json()['chain']
 
     def get_difficulty(self):
-        response = requests.get(f'http://{self.node_address}/difficulty')
+        response = Peers.get(f'http://{self.node_address}/difficulty')
         if response.status_code == 200:
             return response.json()
         else:
@@ -71,7 +71,7 @@ class pool:
 
 
     def get_last_block_hash(self):
-        response = requests.get(f'http://{self.node_address}/chain')
+        response = Peers.get(f'http://{self.node_address}/chain')
 
         if response.status_code == 200:
             length = response.json()['length']
@@ -80,7 +80,7 @@ class pool:
             return chain[length - 1]['current_hash']
 
     def get_last_block(self):
-        response = requests.get(f'http://{self.node_address}/chain')
+        response = Peers.get(f'http://{self.node_address}/chain')
 
         if response.status_code == 200:
             length = response.json()['length']
@@ -93,14 +93,14 @@ class pool:
         return last_block['index']
 
     def get_last_proof(self):
-        response = requests.get(f'http://{self.node_address}/proof')
+        response = Peers.get(f'http://{self.node_address}/proof')
         if response.status_code == 200:
             return response.json()
         else:
             print("couldn't obtain proof")
 
     def get_mempool(self):
-        response = requests.get(f'http://{self.node_address}/mempool')
+        response = Peers.get(f'http://{self.node_address}/mempool')
         if response.status_code == 200:
             return response.json()
         else:
@@ -179,7 +179,7 @@ class pool:
 
         headers = {'Content-type': 'application/json', 'Accept': 'text/plain'}
 
-        response = requests.post(f'http://{self.node_address}/transactions/new', json=transaction, headers=headers)
+        response = Peers.post(f'http://{self.node_address}/transactions/new', json=transaction, headers=headers)
         if response.status_code == 201:
             return True
 
@@ -240,7 +240,7 @@ class pool:
             'signature': proof_signature
         }
 
-        response = requests.post(f'http://{self.node_address}/miners', json=proof_transaction_with_sig, headers=headers)
+        response = Peers.post(f'http://{self.node_address}/miners', json=proof_transaction_with_sig, headers=headers)
 
         if response.status_code == 200:
             print('New Block Forged! Proof Accepted ', proof)
@@ -326,7 +326,7 @@ pool = pool()
 
 @app.route('/chain', methods=['GET'])
 def forward_chain_request():
-    response = requests.get(f'http://{pool.node_address}/chain')
+    response = Peers.get(f'http://{pool.node_address}/chain')
     forward = {
         'chain': response.json()['chain'],
         'length': response.json()['length']
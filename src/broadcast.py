@@ -1,17 +1,142 @@
-import requests
-from requests.exceptions import Timeout
+import threading
+from concurrent.futures import ThreadPoolExecutor, Future
 from time import time
+from src.models import BlockRecord, TransactionRecord
+from src.peers import Peers
 
 
 class Broadcast:
+    # threads shared by every broadcast, a block reaches all our peers in about one round trip instead of one per peer.
+    # blocks have a lane of their own so a burst of transactions queued for the other can't hold them up
+    workers = {'blocks': 16, 'transactions': 48}
+    executors = {}
+    executor_lock = threading.Lock()
+
+    # seconds a broadcast waits for each peer before counting it as timed out, from when its request starts
+    deadline = 10
+
+    # transactions admitted within batch_delay seconds of each other are announced together,
+    # a burst costs every peer one request per batch instead of one per transaction
+    batch_delay = 0.1
+    batch_size = 1000
+    batch = []
+    batch_timer = None
+    batch_lock = threading.Lock()
+
     def __init__(self):
         print("broadcast module starting....")
 
+    @staticmethod
+    def get_executor(lane='blocks'):
+        executor = Broadcast.executors.get(lane)
+        if executor is None:
+            with Broadcast.executor_lock:
+                executor = Broadcast.executors.get(lane)
+                if executor is None:
+                    executor = ThreadPoolExecutor(max_workers=Broadcast.workers[lane],
+                                                  thread_name_prefix=f'broadcast-{lane}')
+                    Broadcast.executors[lane] = executor
+        return executor
+
+    @staticmethod
+    def timed(send, payload, neighbour, deadline):
+        """
+        runs send(payload, neighbour), a node that takes longer than the deadline gets "TimeoutError"
+        the same as one whose request failed. time spent queued for a thread doesn't count
+        """
+        started = time()
+        try:
+            result = send(payload, neighbour)
+        except Exception:
+            return "TimeoutError"
+        if time() - started > deadline:
+            return "TimeoutError"
+        return result
+
+    @staticmethod
+    def send_all(send, payload, nodes, deadline=None, lane='blocks'):
+        """
+        calls send(payload, node) for every node at the same time and waits for them, returns {node: result}.
+        see fan_out for the results
+        """
+        nodes = list(nodes)
+        finished = threading.Event()
+        results = {}
+
+        def on_done(done):
+            results.update(done)
+            finished.set()
+
+        Broadcast.fan_out(send, payload, nodes, on_done, deadline, lane)
+        if nodes:
+            finished.wait()
+        return results
+
+    @staticmethod
+    def fan_out(send, payload, nodes, on_done=None, deadline=None, lane='blocks'):
+        """
+        send_all without waiting, on_done(results) is called by whichever send finishes last
+        so a request handler can answer before every peer has. every send is bounded by the Peers timeouts.
+        a node whose send never got to run, because the executor was shut down, gets "NotSent"
+        """
+        nodes = list(nodes)
+        if not nodes:
+            return
+        if deadline is None:
+            deadline = Broadcast.deadline
+
+        results = {}
+        lock = threading.Lock()
+
+        def finished(future, neighbour):
+            try:
+                result = future.result()
+            except Exception:
+                result = "NotSent"
+            with lock:
+                results[neighbour] = result
+                complete = len(results) == len(nodes)
+            if complete and on_done is not None:
+                on_done(results)
+
+        executor = Broadcast.get_executor(lane)
+        for neighbour in nodes:
+            try:
+                future = executor.submit(Broadcast.timed, send, payload, neighbour, deadline)
+            except RuntimeError:
+                future = Future()
+                future.cancel()
+            future.add_done_callback(lambda future, neighbour=neighbour: finished(future, neighbour))
+
+    @staticmethod
+    def queue_transactions(transactions, announce):
+        """
+        holds transactions back for batch_delay seconds so they go out in one announcement with any others
+        admitted meanwhile. announce(transactions) is called with each batch of at most batch_size
+        """
+        with Broadcast.batch_lock:
+            Broadcast.batch.extend(transactions)
+            if Broadcast.batch_timer is None:
+                Broadcast.batch_timer = threading.Timer(Broadcast.batch_delay, Broadcast.flush_transactions,
+                                                        args=(announce,))
+                Broadcast.batch_timer.daemon = True
+                Broadcast.batch_timer.start()
+
+    @staticmethod
+    def flush_transactions(announce):
+        with Broadcast.batch_lock:
+            batch = Broadcast.batch
+            Broadcast.batch = []
+            Broadcast.batch_timer = None
+
+        for i in range(0, len(batch), Broadcast.batch_size):
+            announce(batch[i:i + Broadcast.batch_size])
+
     @staticmethod
     def broadcast_difficulty(difficulty, node):
         headers = {'Content-type': 'application/json', 'Accept': 'text/plain'}
-        response = requests.post(f'http://{node}/diffupdate', json=difficulty, headers=headers)
         try:
+            response = Peers.post(f'http://{node}/diffupdate', json=difficulty, headers=headers)
             if response.status_code == 200:
                 print(f'difficulty update accepted by {node}')
 
@@ -21,31 +146,106 @@ class Broadcast:
     @staticmethod
     def broadcast_transaction(transaction, node):
         headers = {'Content-type': 'application/json', 'Accept': 'text/plain'}
-        response = requests.post(f'http://{node}/transactions/new', json=transaction, headers=headers)
         try:
+            response = Peers.post(f'http://{node}/transactions/new', json=TransactionRecord.plain(transaction),
+                                  headers=headers)
             if response.status_code == 201:
                 print('transaction broadcast accepted by: ', node)
+                return True
 
             else:
                 print('transaction broadcast denied by: ', node)
+                return False
+
+        except:
+            return "TimeoutError"
+
+    @staticmethod
+    def broadcast_transactions(transactions, node):
+        """
+        sends a list of transactions to /transactions/batch, older nodes without the
+        batch endpoint get them one at a time instead
+        """
+        headers = {'Content-type': 'application/json', 'Accept': 'application/json'}
+        batch = [TransactionRecord.plain(transaction) for transaction in transactions]
+        try:
+            response = Peers.post(f'http://{node}/transactions/batch', json=batch, headers=headers)
+
+            if response.status_code == 404:
+                for transaction in transactions:
+                    Broadcast.broadcast_transaction(transaction, node)
+
+            elif response.status_code == 200:
+                print(f'{response.json()["accepted"]} of {len(transactions)} transactions accepted by: ', node)
+
+            else:
+                print('transaction batch denied by: ', node)
 
         except:
             return "TimeoutError"
 
 
+    @staticmethod
+    def announce(inventory, node):
+        """
+        offers the hashes of new blocks and transactions to a node through /inv, it fetches the ones it doesn't
+        have from our /getdata, so nothing it already has is sent again.
+        nodes without /inv, or that couldn't reach us to fetch them, get the bodies pushed instead.
+        :param inventory: <dict> our port and the blocks and transactions, see Node.inventory
+        returns True if the node took every block, False if it rejected one, "TimeoutError" if it didn't answer
+        """
+        headers = {'Content-type': 'application/json', 'Accept': 'application/json'}
+        offer = {
+            'port': inventory['port'],
+            'blocks': [block['current_hash'] for block in inventory['blocks']],
+            'transactions': [transaction.get('transaction_hash') for transaction in inventory['transactions']]
+        }
+        try:
+            response = Peers.post(f'http://{node}/inv', json=offer, headers=headers)
+            if response.status_code == 200:
+                return response.json()['accepted']
+
+        except:
+            return "TimeoutError"
+
+        return Broadcast.push(inventory, node)
+
+    @staticmethod
+    def push(inventory, node):
+        """
+        sends the whole blocks and transactions of an inventory to a node, the way it was done before /inv
+        """
+        status = True
+        for block in inventory['block_bytes']:
+            result = Broadcast.broadcast_block(block, node)
+            if result is not True:
+                status = result
+
+        transactions = inventory['transactions']
+        if len(transactions) == 1:
+            Broadcast.broadcast_transaction(transactions[0], node)
+        elif transactions:
+            Broadcast.broadcast_transactions(transactions, node)
+        return status
+
     @staticmethod
     def broadcast_block(block, node):
 
         current_time = str(time())
         headers = {'Content-type': 'application/json', 'Accept': 'text/plain'}
         try:
-            response = requests.post(f'http://{node}/broadcast', json=block, headers=headers)
+            # push passes the json bytes built once in the inventory, so they aren't rebuilt for every node
+            if not isinstance(block, bytes):
+                block = BlockRecord.wrap(block).json_bytes()
+            response = Peers.post(f'http://{node}/broadcast', data=block, headers=headers)
 
             if response.status_code == 200:
                 print("Block broadcast accepted by ", node, "at ", current_time)
+                return True
 
             else:
-                return False, print("block not accepted")
+                print("block not accepted")
+                return False
 
         except:
             return "TimeoutError"
@@ -0,0 +1,66 @@
+import os
+import json
+import binascii
+from Crypto.Hash import SHA256
+from Crypto.Signature import pkcs1_15
+from src.validation import Signature
+
+
+class Checkpoint:
+    """
+    signed "validated up to height H / hash X" watermark kept next to the block store.
+    the node signs it with its own wallet key, so on startup only the blocks
+    after the watermark need to be validated again.
+    """
+    def __init__(self, filename='data/blocks/checkpoint.json'):
+        self.filename = filename
+
+    def load(self, public_key_hex, store):
+        """
+        returns the height of the last validated block, or 0 if there is no usable checkpoint.
+        a checkpoint is only trusted if our key signed it and the block at that height still has the recorded hash
+        """
+        if not os.path.isfile(self.filename):
+            return 0
+
+        try:
+            checkpoint = json.load(open(self.filename, 'r'))
+            watermark = {
+                'height': checkpoint['height'],
+                'hash': checkpoint['hash']
+            }
+            signature = checkpoint['signature']
+        except (ValueError, KeyError):
+            print("checkpoint file is unreadable, ignoring it")
+            return 0
+
+        if not Signature.validate_signature(public_key_hex, signature, watermark):
+            print("checkpoint signature invalid, ignoring it")
+            return 0
+
+        height = watermark['height']
+        if height >= len(store) or store.entry(height)[3] != store.hash_key(watermark['hash']):
+            print("checkpoint no longer matches the local chain, ignoring it")
+            return 0
+
+        return height
+
+    def save(self, height, block_hash, private_key):
+        """
+        signs and writes a new watermark, the file is swapped in atomically so a crash
+        leaves either the old checkpoint or the new one
+        """
+        watermark = {
+            'height': height,
+            'hash': block_hash
+        }
+        transaction_bytes = json.dumps(watermark, sort_keys=True).encode('utf-8')
+        signature = pkcs1_15.new(private_key).sign(SHA256.new(transaction_bytes))
+        watermark['signature'] = binascii.hexlify(signature).decode('utf-8')
+
+        temp = self.filename + '.tmp'
+        with open(temp, 'w') as f:
+            json.dump(watermark, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp, self.filename)
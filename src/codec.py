@@ -0,0 +1,349 @@
+import json
+import struct
+
+
+class CodecError(ValueError):
+    pass
+
+
+class Codec:
+    """
+    compact binary encoding for blocks and transactions, used on disk and on the wire.
+
+    every field is written in a fixed order with a fixed width where possible, hex hashes,
+    addresses, keys and signatures are stored as raw bytes instead of hex text, and key names
+    are never written. the encoding is canonical (the same block always gives the same bytes)
+    so it is also fine to hash.
+
+    values that don't fit the usual shape (a genesis previous_hash that isn't a hash, an int amount
+    instead of a float...) get a tag byte saying how they were stored, so decoding always
+    gives back exactly what went in and the json hashes still match.
+    anything with missing or extra fields raises CodecError, callers fall back to json for those.
+
+    the block store passes its KeyTable in, public keys are then written as a key id instead of the
+    whole key. those records can only be read back with the same table, so they never go on the wire.
+    """
+    VERSION = 1
+    CONTENT_TYPE = 'application/x-pychain'
+
+    BLOCK_FIELDS = ['index', 'timestamp', 'transactions', 'difficulty', 'proof', 'previous_hash', 'current_hash']
+    TRANSACTION_FIELDS = ['sender', 'recipient', 'amount', 'fee', 'time_submitted', 'previous_block_hash',
+                          'public_key_hex', 'transaction_hash', 'signature']
+
+    # field tags
+    RAW = 0
+    TEXT = 1
+    NONE = 2
+    KEY_ID = 3
+    INT = 0
+    FLOAT = 1
+    BIG_INT = 2
+
+    INT64 = struct.Struct('<q')
+    DOUBLE = struct.Struct('<d')
+
+    # writing helpers
+
+    @staticmethod
+    def write_varint(out, value):
+        while True:
+            byte = value & 0x7f
+            value >>= 7
+            if value:
+                out.append(byte | 0x80)
+            else:
+                out.append(byte)
+                return
+
+    @staticmethod
+    def write_bytes(out, data):
+        Codec.write_varint(out, len(data))
+        out += data
+
+    @staticmethod
+    def write_hex(out, value, size=None):
+        """
+        hex strings go in as raw bytes, fixed width if the size is known.
+        only used when converting back gives the exact same string (lower case, right length)
+        """
+        if value is None:
+            out.append(Codec.NONE)
+            return
+        if not isinstance(value, str):
+            raise CodecError(f'expected a string, got {type(value).__name__}')
+
+        try:
+            raw = bytes.fromhex(value)
+        except ValueError:
+            raw = None
+
+        if raw is not None and raw.hex() == value and (size is None or len(raw) == size):
+            out.append(Codec.RAW)
+            if size is None:
+                Codec.write_bytes(out, raw)
+            else:
+                out += raw
+        else:
+            out.append(Codec.TEXT)
+            Codec.write_bytes(out, value.encode('utf-8'))
+
+    @staticmethod
+    def write_key(out, value, keys):
+        """
+        public keys go in as an id from the key table, anything that isn't a hex key is written as usual
+        """
+        raw = None
+        if isinstance(value, str):
+            try:
+                raw = bytes.fromhex(value)
+            except ValueError:
+                pass
+
+        if raw is None or raw.hex() != value:
+            Codec.write_hex(out, value)
+            return
+        out.append(Codec.KEY_ID)
+        Codec.write_varint(out, keys.key_id(raw))
+
+    @staticmethod
+    def write_number(out, value):
+        # bool is an int in python but json writes it differently, so we don't accept it
+        if isinstance(value, bool) or not isinstance(value, (int, float)):
+            raise CodecError(f'expected a number, got {type(value).__name__}')
+
+        if isinstance(value, float):
+            out.append(Codec.FLOAT)
+            out += Codec.DOUBLE.pack(value)
+        elif -2 ** 63 <= value < 2 ** 63:
+            out.append(Codec.INT)
+            out += Codec.INT64.pack(value)
+        else:
+            out.append(Codec.BIG_INT)
+            Codec.write_bytes(out, str(value).encode())
+
+    @staticmethod
+    def check_fields(data, fields):
+        if not isinstance(data, dict) or len(data) != len(fields) or not all(k in data for k in fields):
+            raise CodecError('unexpected fields')
+
+    # reading helpers
+
+    @staticmethod
+    def read_varint(data, pos):
+        value = 0
+        shift = 0
+        while True:
+            byte = data[pos]
+            pos += 1
+            value |= (byte & 0x7f) << shift
+            if not byte & 0x80:
+                return value, pos
+            shift += 7
+
+    @staticmethod
+    def read_slice(data, pos, length):
+        """
+        the next length bytes, slicing past the end would quietly give back fewer
+        """
+        if pos + length > len(data):
+            raise CodecError('truncated data')
+        return bytes(data[pos:pos + length]), pos + length
+
+    @staticmethod
+    def read_bytes(data, pos):
+        length, pos = Codec.read_varint(data, pos)
+        return Codec.read_slice(data, pos, length)
+
+    @staticmethod
+    def read_hex(data, pos, size=None):
+        tag = data[pos]
+        pos += 1
+        if tag == Codec.NONE:
+            return None, pos
+        if tag == Codec.TEXT:
+            raw, pos = Codec.read_bytes(data, pos)
+            return raw.decode('utf-8'), pos
+        if tag != Codec.RAW:
+            raise CodecError(f'unknown field tag {tag}')
+        if size is None:
+            raw, pos = Codec.read_bytes(data, pos)
+        else:
+            raw, pos = Codec.read_slice(data, pos, size)
+        return raw.hex(), pos
+
+    @staticmethod
+    def read_key(data, pos, keys):
+        if data[pos] != Codec.KEY_ID:
+            return Codec.read_hex(data, pos)
+        if keys is None:
+            raise CodecError('key id without a key table')
+        key_id, pos = Codec.read_varint(data, pos + 1)
+        return keys.key(key_id).hex(), pos
+
+    @staticmethod
+    def read_number(data, pos):
+        tag = data[pos]
+        pos += 1
+        if tag == Codec.FLOAT:
+            return Codec.DOUBLE.unpack_from(data, pos)[0], pos + Codec.DOUBLE.size
+        if tag == Codec.INT:
+            return Codec.INT64.unpack_from(data, pos)[0], pos + Codec.INT64.size
+        if tag != Codec.BIG_INT:
+            raise CodecError(f'unknown number tag {tag}')
+        raw, pos = Codec.read_bytes(data, pos)
+        return int(raw), pos
+
+    # transactions
+
+    @staticmethod
+    def write_transaction(out, transaction, keys=None):
+        Codec.check_fields(transaction, Codec.TRANSACTION_FIELDS)
+        Codec.write_hex(out, transaction['sender'], 20)
+        Codec.write_hex(out, transaction['recipient'], 20)
+        Codec.write_number(out, transaction['amount'])
+        Codec.write_number(out, transaction['fee'])
+        Codec.write_number(out, transaction['time_submitted'])
+        Codec.write_hex(out, transaction['previous_block_hash'], 32)
+        if keys is None:
+            Codec.write_hex(out, transaction['public_key_hex'])
+        else:
+            Codec.write_key(out, transaction['public_key_hex'], keys)
+        Codec.write_hex(out, transaction['transaction_hash'], 32)
+        Codec.write_hex(out, transaction['signature'])
+
+    @staticmethod
+    def read_transaction(data, pos, keys=None):
+        transaction = {}
+        transaction['sender'], pos = Codec.read_hex(data, pos, 20)
+        transaction['recipient'], pos = Codec.read_hex(data, pos, 20)
+        transaction['amount'], pos = Codec.read_number(data, pos)
+        transaction['fee'], pos = Codec.read_number(data, pos)
+        transaction['time_submitted'], pos = Codec.read_number(data, pos)
+        transaction['previous_block_hash'], pos = Codec.read_hex(data, pos, 32)
+        transaction['public_key_hex'], pos = Codec.read_key(data, pos, keys)
+        transaction['transaction_hash'], pos = Codec.read_hex(data, pos, 32)
+        transaction['signature'], pos = Codec.read_hex(data, pos)
+        return transaction, pos
+
+    @staticmethod
+    def encode_transaction(transaction):
+        out = bytearray([Codec.VERSION])
+        Codec.write_transaction(out, transaction)
+        return bytes(out)
+
+    @staticmethod
+    def decode_transaction(data):
+        Codec.check_version(data)
+        try:
+            transaction, pos = Codec.read_transaction(data, 1)
+            Codec.check_end(data, pos)
+            return transaction
+        except CodecError:
+            raise
+        except (IndexError, struct.error, ValueError):
+            raise CodecError('truncated or corrupt transaction')
+
+    # blocks
+
+    @staticmethod
+    def encode_block(block, keys=None):
+        Codec.check_fields(block, Codec.BLOCK_FIELDS)
+        if not isinstance(block['transactions'], list):
+            raise CodecError('transactions must be a list')
+        out = bytearray([Codec.VERSION])
+        Codec.write_number(out, block['index'])
+        Codec.write_number(out, block['timestamp'])
+        Codec.write_number(out, block['difficulty'])
+        Codec.write_number(out, block['proof'])
+        Codec.write_hex(out, block['previous_hash'], 32)
+        Codec.write_hex(out, block['current_hash'], 32)
+
+        Codec.write_varint(out, len(block['transactions']))
+        for transaction in block['transactions']:
+            Codec.write_transaction(out, transaction, keys)
+        return bytes(out)
+
+    @staticmethod
+    def decode_block(data, keys=None):
+        Codec.check_version(data)
+        try:
+            block, pos = Codec.read_block(data, 1, keys)
+            Codec.check_end(data, pos)
+            return block
+        except CodecError:
+            raise
+        except (IndexError, struct.error, ValueError):
+            raise CodecError('truncated or corrupt block')
+
+    @staticmethod
+    def read_block(data, pos, keys=None):
+        block = {}
+        block['index'], pos = Codec.read_number(data, pos)
+        block['timestamp'], pos = Codec.read_number(data, pos)
+        block['difficulty'], pos = Codec.read_number(data, pos)
+        block['proof'], pos = Codec.read_number(data, pos)
+        block['previous_hash'], pos = Codec.read_hex(data, pos, 32)
+        block['current_hash'], pos = Codec.read_hex(data, pos, 32)
+
+        count, pos = Codec.read_varint(data, pos)
+        block['transactions'] = []
+        for i in range(count):
+            transaction, pos = Codec.read_transaction(data, pos, keys)
+            block['transactions'].append(transaction)
+        return block, pos
+
+    @staticmethod
+    def check_version(data):
+        if not data or data[0] != Codec.VERSION:
+            raise CodecError('unknown encoding version')
+
+    @staticmethod
+    def check_end(data, pos):
+        # bytes left over mean it isn't the record we think it is
+        if pos != len(data):
+            raise CodecError('unexpected bytes after the end of the record')
+
+    # lists of blocks, used when sending a branch over the wire
+
+    @staticmethod
+    def encode_blocks(blocks):
+        out = bytearray()
+        Codec.write_varint(out, len(blocks))
+        for block in blocks:
+            Codec.write_bytes(out, Codec.encode_block(block))
+        return bytes(out)
+
+    @staticmethod
+    def decode_blocks(data):
+        try:
+            count, pos = Codec.read_varint(data, 0)
+        except IndexError:
+            raise CodecError('empty block list')
+        blocks = []
+        try:
+            for i in range(count):
+                raw, pos = Codec.read_bytes(data, pos)
+                blocks.append(Codec.decode_block(raw))
+        except IndexError:
+            raise CodecError('truncated block list')
+        Codec.check_end(data, pos)
+        return blocks
+
+    # json compatibility, old peers and old store records only speak json
+
+    @staticmethod
+    def dumps_block(block, keys=None):
+        """
+        binary encoding when the block fits it, json otherwise.
+        json always starts with '{' so the two can't be confused when reading back
+        """
+        try:
+            return Codec.encode_block(block, keys)
+        except CodecError:
+            return json.dumps(block).encode()
+
+    @staticmethod
+    def loads_block(data, keys=None):
+        if data[:1] == b'{':
+            return json.loads(data)
+        return Codec.decode_block(data, keys)
@@ -1,4 +1,4 @@
-import requests
+from src.peers import Peers
 
 class Epoch:
     """
@@ -80,7 +80,7 @@ class Epoch:
         """
         returns the difficulty from a registered node.
         """
-        response = requests.get(f'{node}/difficulty')
+        response = Peers.get(f'{node}/difficulty')
         return response.json()
 
     @staticmethod
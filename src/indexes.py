@@ -0,0 +1,321 @@
+import os
+import sqlite3
+import threading
+
+
+class ChainIndex:
+    """
+    base class for indexes that are kept up to date as blocks are connected to and
+    disconnected from the chain. each index is a sqlite database next to the block store,
+    lookups read just the rows they need so nothing is held in memory and startup doesn't
+    depend on how long the chain is. the height and hash of the last block the index has seen
+    are kept in the same database and committed together with the rows every few blocks;
+    on startup it catches up from that block, or is rebuilt from the chain if the database
+    is new or on another branch.
+    """
+    # commit after this many connected blocks
+    save_every = 10
+
+    # CREATE statements for the index's tables, and the tables emptied when it is rebuilt
+    SCHEMA = []
+    TABLES = []
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.height = -1
+        self.tip_hash = None
+        self.unsaved = 0
+
+        directory = os.path.dirname(filename)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+
+        # one connection shared by the request threads, every use of it goes through the lock
+        self.lock = threading.RLock()
+        self.db = sqlite3.connect(filename, check_same_thread=False)
+        # losing the last few commits in a power cut only means replaying a few blocks on startup
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value)')
+        for statement in self.SCHEMA:
+            self.db.execute(statement)
+        self.db.commit()
+
+    # subclasses fill these in
+
+    def connect(self, height, block):
+        raise NotImplementedError
+
+    def disconnect(self, height, block):
+        raise NotImplementedError
+
+    # shared bookkeeping
+
+    def apply_block(self, height, block):
+        with self.lock:
+            self.connect(height, block)
+            self.height = height
+            self.tip_hash = block['current_hash']
+            self.unsaved += 1
+            if self.unsaved >= self.save_every:
+                self.save()
+
+    def revert_block(self, height, block):
+        """
+        undoes a block, blocks have to be reverted newest first
+        """
+        with self.lock:
+            self.disconnect(height, block)
+            self.height = height - 1
+            self.tip_hash = block['previous_hash']
+            self.unsaved += 1
+
+    def clear(self):
+        with self.lock:
+            for table in self.TABLES:
+                self.db.execute(f'DELETE FROM {table}')
+
+    def load(self, chain, undo=None):
+        """
+        picks up from the last committed block and applies any blocks added since.
+        undo is the undo records of a reorg that was finished on startup, an index still on the branch
+        it disconnected is reverted to the fork from them instead of being rebuilt
+        """
+        with self.lock:
+            meta = dict(self.db.execute('SELECT key, value FROM meta').fetchall())
+            height = meta.get('height', -1)
+            if 'height' in meta and height < len(chain) and \
+                    (height < 0 or chain[height]['current_hash'] == meta.get('hash')):
+                self.height = height
+                self.tip_hash = meta.get('hash')
+            elif 'height' in meta and self.rewind(height, meta.get('hash'), undo):
+                pass
+            else:
+                if 'height' in meta:
+                    print(f"{self.filename} is from another branch, rebuilding it")
+                self.clear()
+                self.height = -1
+                self.tip_hash = None
+
+            for height in range(self.height + 1, len(chain)):
+                self.apply_block(height, chain[height])
+            self.save()
+
+    def rewind(self, height, tip_hash, undo):
+        """
+        reverts an index left at a block the reorg disconnected back to the fork,
+        returns False if it isn't on that branch
+        """
+        blocks = {record['height']: record['block'] for record in undo or ()}
+        if height not in blocks or blocks[height]['current_hash'] != tip_hash:
+            return False
+
+        print(f"{self.filename} is on the branch a reorg replaced, reverting it to the fork")
+        self.height = height
+        self.tip_hash = tip_hash
+        for height in range(self.height, min(blocks) - 1, -1):
+            self.revert_block(height, blocks[height])
+        return True
+
+    def save(self):
+        """
+        commits everything applied so far together with the height it got up to
+        """
+        with self.lock:
+            self.db.executemany('INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)',
+                                [('height', self.height), ('hash', self.tip_hash)])
+            self.db.commit()
+            self.unsaved = 0
+
+    def close(self):
+        with self.lock:
+            self.save()
+            self.db.close()
+
+
+class BalanceIndex(ChainIndex):
+    """
+    running total of coins received and spent per address, so a balance is one row lookup
+    instead of a walk over every transaction in the chain.
+    gives the same answer as Funds.enumerate_funds.
+    """
+    # NUMERIC keeps whole amounts as integers, like the json they came from
+    SCHEMA = ['CREATE TABLE IF NOT EXISTS balances (address TEXT PRIMARY KEY, received NUMERIC, spent NUMERIC)']
+    TABLES = ['balances']
+
+    def __init__(self, filename='data/indexes/balances.db'):
+        super().__init__(filename)
+
+    def add(self, address, received, spent):
+        self.db.execute('INSERT INTO balances (address, received, spent) VALUES (?, ?, ?) '
+                        'ON CONFLICT (address) DO UPDATE SET received = received + excluded.received, '
+                        'spent = spent + excluded.spent', (address, received, spent))
+
+    def connect(self, height, block):
+        for transaction in block['transactions']:
+            self.add(transaction['recipient'], transaction['amount'], 0)
+            self.add(transaction['sender'], 0, transaction['amount'])
+            self.add(transaction['sender'], 0, transaction['fee'])
+
+    def disconnect(self, height, block):
+        for transaction in reversed(block['transactions']):
+            self.add(transaction['sender'], 0, -transaction['fee'])
+            self.add(transaction['sender'], 0, -transaction['amount'])
+            self.add(transaction['recipient'], -transaction['amount'], 0)
+
+    def balance(self, address):
+        """
+        returns the confirmed balance of an address, 0 if it has never been used
+        """
+        if not isinstance(address, str):
+            return 0
+        with self.lock:
+            row = self.db.execute('SELECT received, spent FROM balances WHERE address = ?', (address,)).fetchone()
+        if row is None:
+            return 0
+        return row[0] - row[1]
+
+
+class AddressIndex(ChainIndex):
+    """
+    every (block height, position in block) an address shows up in as sender or recipient,
+    oldest first, so an address history doesn't need the whole chain.
+    seq numbers an address's entries from 0, it is what the history cursor counts in
+    """
+    SCHEMA = ['CREATE TABLE IF NOT EXISTS positions (address TEXT, seq INTEGER, height INTEGER, position INTEGER, '
+              'PRIMARY KEY (address, seq))',
+              'CREATE INDEX IF NOT EXISTS positions_height ON positions (height)']
+    TABLES = ['positions']
+
+    def __init__(self, filename='data/indexes/addresses.db'):
+        super().__init__(filename)
+
+    def count(self, address):
+        row = self.db.execute('SELECT MAX(seq) FROM positions WHERE address = ?', (address,)).fetchone()
+        return 0 if row[0] is None else row[0] + 1
+
+    def connect(self, height, block):
+        for position, transaction in enumerate(block['transactions']):
+            for address in self.addresses(transaction):
+                self.db.execute('INSERT INTO positions (address, seq, height, position) VALUES (?, ?, ?, ?)',
+                                (address, self.count(address), height, position))
+
+    def disconnect(self, height, block):
+        # blocks are reverted newest first, so everything from this height up is the end of each address's history
+        self.db.execute('DELETE FROM positions WHERE height >= ?', (height,))
+
+    @staticmethod
+    def addresses(transaction):
+        if transaction['sender'] == transaction['recipient']:
+            return [transaction['sender']]
+        return [transaction['sender'], transaction['recipient']]
+
+    def history(self, address, cursor=None, limit=50):
+        """
+        returns one page of [height, position] entries for an address, newest first,
+        and the cursor for the next (older) page, None when there are no more.
+        the cursor is a position in the address's history so pages stay put as new blocks arrive
+        """
+        with self.lock:
+            count = self.count(address)
+            end = count if cursor is None else min(cursor, count)
+            start = max(end - limit, 0)
+            rows = self.db.execute('SELECT height, position FROM positions WHERE address = ? AND seq >= ? AND seq < ? '
+                                   'ORDER BY seq DESC', (address, start, end)).fetchall()
+        page = [list(row) for row in rows]
+        next_cursor = start if start > 0 else None
+        return page, next_cursor
+
+
+class TransactionIndex(ChainIndex):
+    """
+    transaction_hash -> [block height, position in block] for every confirmed transaction
+    """
+    SCHEMA = ['CREATE TABLE IF NOT EXISTS locations (hash TEXT PRIMARY KEY, height INTEGER, position INTEGER)',
+              'CREATE INDEX IF NOT EXISTS locations_height ON locations (height)']
+    TABLES = ['locations']
+
+    def __init__(self, filename='data/indexes/transactions.db'):
+        super().__init__(filename)
+
+    def connect(self, height, block):
+        self.db.executemany('INSERT OR REPLACE INTO locations (hash, height, position) VALUES (?, ?, ?)',
+                            [(transaction['transaction_hash'], height, position)
+                             for position, transaction in enumerate(block['transactions'])])
+
+    def disconnect(self, height, block):
+        self.db.execute('DELETE FROM locations WHERE height = ?', (height,))
+
+    def location(self, transaction_hash):
+        """
+        returns [height, position] of a confirmed transaction, or None
+        """
+        if not isinstance(transaction_hash, str):
+            return None
+        with self.lock:
+            row = self.db.execute('SELECT height, position FROM locations WHERE hash = ?',
+                                  (transaction_hash,)).fetchone()
+        return list(row) if row is not None else None
+
+
+class PendingBalances:
+    """
+    confirmed balances with the mempool on top: what an address will have once everything pending
+    is confirmed, pending spends (amount and fee) taken off and pending incoming amounts added.
+    answers balance() like BalanceIndex, so it can be checked against in its place.
+    not a chain index, the mempool keeps it up to date as transactions come and go
+    """
+    def __init__(self, confirmed=None):
+        # the BalanceIndex underneath, until it is set only the pending amounts count
+        self.confirmed = confirmed
+        # address -> [pending received, pending spent including fees, number of pending transactions]
+        self.totals = {}
+
+    @staticmethod
+    def number(value):
+        if isinstance(value, bool) or not isinstance(value, (int, float)):
+            return 0
+        return value
+
+    def add(self, transaction):
+        amount = self.number(transaction.get('amount'))
+        fee = self.number(transaction.get('fee'))
+
+        received = self.totals.setdefault(transaction.get('recipient'), [0, 0, 0])
+        received[0] += amount
+        received[2] += 1
+
+        sent = self.totals.setdefault(transaction.get('sender'), [0, 0, 0])
+        sent[1] += amount + fee
+        sent[2] += 1
+
+    def remove(self, transaction):
+        amount = self.number(transaction.get('amount'))
+        fee = self.number(transaction.get('fee'))
+
+        for address, side, value in ((transaction.get('recipient'), 0, amount),
+                                     (transaction.get('sender'), 1, amount + fee)):
+            totals = self.totals.get(address)
+            if totals is None:
+                continue
+            totals[side] -= value
+            totals[2] -= 1
+            # dropped once nothing is pending so rounding can't leave dust behind
+            if totals[2] <= 0:
+                del self.totals[address]
+
+    def pending(self, address):
+        """
+        what the mempool adds to an address, received minus spent
+        """
+        totals = self.totals.get(address)
+        if totals is None:
+            return 0
+        return totals[0] - totals[1]
+
+    def balance(self, address):
+        """
+        returns the balance of an address with everything in the mempool applied
+        """
+        confirmed = self.confirmed.balance(address) if self.confirmed is not None else 0
+        return confirmed + self.pending(address)
@@ -0,0 +1,68 @@
+import os
+import threading
+from src.wal import WriteAheadLog
+
+
+class KeyTable:
+    """
+    every public key that appears in a stored block, numbered in the order they were first seen.
+    blocks in the store refer to keys by their number instead of repeating the whole DER key
+    in every transaction, the table turns the numbers back into keys when blocks are read.
+
+    keys.dat is a write ahead log with one DER key per record, a key's id is its position in the log.
+    new keys are rare so every one is fsynced straight away, before the block that uses it is written.
+    """
+    def __init__(self, filename, read_only=False):
+        self.filename = filename
+        self.read_only = read_only
+        self.lock = threading.Lock()
+
+        # id -> DER bytes, and DER bytes -> id
+        self.keys = []
+        self.ids = {}
+
+        if not os.path.isfile(filename):
+            open(filename, 'wb').close()
+
+        if read_only:
+            self.log = None
+            records, _ = WriteAheadLog.scan(filename)
+        else:
+            self.log = WriteAheadLog(filename, sync_every=1)
+            records = self.log.recover()
+
+        for offset, key in records:
+            self.ids[key] = len(self.keys)
+            self.keys.append(key)
+
+    def __len__(self):
+        return len(self.keys)
+
+    def key_id(self, key):
+        """
+        returns the id of a DER key, adding it to the table if it is new
+        """
+        key_id = self.ids.get(key)
+        if key_id is not None:
+            return key_id
+
+        with self.lock:
+            key_id = self.ids.get(key)
+            if key_id is None:
+                if self.read_only:
+                    raise ValueError('key table is read only')
+                self.log.append(key)
+                key_id = len(self.keys)
+                self.keys.append(key)
+                self.ids[key] = key_id
+            return key_id
+
+    def key(self, key_id):
+        """
+        returns the DER key for an id, raises IndexError for an id we don't have
+        """
+        return self.keys[key_id]
+
+    def close(self):
+        if self.log is not None:
+            self.log.close()
@@ -0,0 +1,98 @@
+import os
+import json
+from src.wal import WriteAheadLog
+from src.codec import Codec, CodecError
+from src.models import TransactionRecord
+
+
+class MempoolLog:
+    """
+    on disk copy of the mempool so pending transactions survive a restart.
+
+    every admitted transaction is appended as an ADD record and every transaction that leaves
+    the mempool as a REMOVE record holding its hash. replaying the log gives back the mempool.
+    once most of the log is dead records it is rewritten with just the live transactions.
+
+    losing the last few records in a crash only loses a few pending transactions, so the log
+    syncs in groups instead of on every write.
+    """
+    ADD = 0
+    REMOVE = 1
+
+    # rewrite once there are this many more records than live transactions
+    compact_slack = 1000
+
+    def __init__(self, filename='data/mempool.dat', sync_every=100, sync_interval=1000):
+        self.filename = filename
+        self.sync_every = sync_every
+        self.sync_interval = sync_interval
+
+        directory = os.path.dirname(filename)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+
+        self.wal = WriteAheadLog(filename, sync_every, sync_interval)
+        self.records = 0
+
+    @staticmethod
+    def encode(transaction):
+        transaction = TransactionRecord.plain(transaction)
+        try:
+            return Codec.encode_transaction(transaction)
+        except CodecError:
+            return json.dumps(transaction).encode()
+
+    @staticmethod
+    def decode(data):
+        if data[:1] == b'{':
+            return json.loads(data)
+        return Codec.decode_transaction(data)
+
+    def load(self):
+        """
+        replays the log and returns the transactions still pending, in the order they arrived
+        """
+        pending = {}
+        records = self.wal.recover()
+        for offset, payload in records:
+            try:
+                if payload[0] == self.ADD:
+                    transaction = self.decode(payload[1:])
+                    pending.setdefault(transaction.get('transaction_hash'), transaction)
+                elif payload[0] == self.REMOVE:
+                    pending.pop(payload[1:].decode(), None)
+            except (CodecError, ValueError, AttributeError):
+                print(f'{self.filename}: skipping unreadable record at {offset}')
+        self.records = len(records)
+        return list(pending.values())
+
+    def add(self, transaction):
+        self.wal.append(bytes([self.ADD]) + self.encode(transaction))
+        self.records += 1
+
+    def remove(self, transaction_hash):
+        self.wal.append(bytes([self.REMOVE]) + str(transaction_hash).encode())
+        self.records += 1
+
+    def needs_compacting(self, live):
+        return self.records > 2 * live + self.compact_slack
+
+    def rewrite(self, transactions):
+        """
+        replaces the log with one ADD record per live transaction
+        """
+        temp = self.filename + '.tmp'
+        if os.path.exists(temp):
+            os.remove(temp)
+        compacted = WriteAheadLog(temp, sync_every=len(transactions) + 1)
+        for transaction in transactions:
+            compacted.append(bytes([self.ADD]) + self.encode(transaction))
+        compacted.close()
+
+        self.wal.close()
+        os.replace(temp, self.filename)
+        self.wal = WriteAheadLog(self.filename, self.sync_every, self.sync_interval)
+        self.records = len(transactions)
+
+    def close(self):
+        self.wal.close()
@@ -0,0 +1,275 @@
+import sys
+import json
+import hashlib
+from src.cache import LRUCache
+
+
+class Record:
+    """
+    base for the compact in-memory blocks and transactions.
+
+    fields live in __slots__ instead of a dict, hex hashes, keys and signatures are kept as raw bytes
+    (half the size of the hex text) and addresses are interned so every copy of an address is the same
+    string. indexing with the usual keys gives back the same values the dict had, so code that reads
+    block['current_hash'] or transaction['sender'] doesn't change. anything that leaves the node
+    (json responses, requests, journals) has to go through to_dict() first.
+    """
+    __slots__ = ()
+
+    FIELDS = []
+    # fields stored as bytes when they are canonical lower case hex
+    HEX_FIELDS = frozenset()
+
+    @staticmethod
+    def pack_hex(value):
+        if not isinstance(value, str):
+            return value
+        try:
+            raw = bytes.fromhex(value)
+        except ValueError:
+            return value
+        # only when turning it back into hex gives exactly the same string
+        if raw.hex() != value:
+            return value
+        return raw
+
+    @staticmethod
+    def intern(value):
+        if isinstance(value, str):
+            return sys.intern(value)
+        return value
+
+    def __getitem__(self, key):
+        if key not in self.FIELDS:
+            raise KeyError(key)
+        value = getattr(self, key)
+        if isinstance(value, bytes):
+            return value.hex()
+        return value
+
+    def __setitem__(self, key, value):
+        if key not in self.FIELDS:
+            raise KeyError(key)
+        self.set_field(key, value)
+
+    def set_field(self, key, value):
+        if key in self.HEX_FIELDS:
+            value = self.pack_hex(value)
+        setattr(self, key, value)
+
+    def get(self, key, default=None):
+        if key not in self.FIELDS:
+            return default
+        return self[key]
+
+    def __contains__(self, key):
+        return key in self.FIELDS
+
+    def __iter__(self):
+        return iter(self.FIELDS)
+
+    def __len__(self):
+        return len(self.FIELDS)
+
+    def keys(self):
+        return list(self.FIELDS)
+
+    def to_dict(self):
+        return {k: self[k] for k in self.FIELDS}
+
+    def __eq__(self, other):
+        if isinstance(other, Record):
+            other = other.to_dict()
+        if not isinstance(other, dict):
+            return NotImplemented
+        return self.to_dict() == other
+
+    # mutable like the dicts they replace, so not hashable
+    __hash__ = None
+
+    def __repr__(self):
+        return repr(self.to_dict())
+
+
+class TransactionRecord(Record):
+    """
+    compact transaction. a transaction that doesn't have exactly the usual fields stays a plain dict
+    """
+    FIELDS = ['sender', 'recipient', 'amount', 'fee', 'time_submitted', 'previous_block_hash',
+              'public_key_hex', 'transaction_hash', 'signature']
+    HEX_FIELDS = frozenset(['previous_block_hash', 'public_key_hex', 'transaction_hash', 'signature'])
+    __slots__ = FIELDS + ['_body_hash', '_signed_hash']
+
+    # what the transaction hash covers, and what the signature covers
+    HASHED_FIELDS = ['sender', 'recipient', 'amount', 'fee', 'time_submitted', 'previous_block_hash', 'public_key_hex']
+    SIGNED_FIELDS = HASHED_FIELDS + ['transaction_hash']
+
+    # a few keys sign most transactions, every transaction by the same key shares one bytes object
+    public_keys = LRUCache(max_size=4096)
+
+    def __init__(self, data):
+        self._body_hash = None
+        self._signed_hash = None
+        for k in self.FIELDS:
+            self.set_field(k, data[k])
+
+    def set_field(self, key, value):
+        # the digests are kept once worked out, until a field they cover changes
+        if key in self.SIGNED_FIELDS:
+            self._signed_hash = None
+            if key != 'transaction_hash':
+                self._body_hash = None
+        if key == 'sender' or key == 'recipient':
+            value = self.intern(value)
+        elif key in self.HEX_FIELDS:
+            value = self.pack_hex(value)
+            if key == 'public_key_hex' and isinstance(value, bytes):
+                shared = self.public_keys.get(value)
+                if shared is None:
+                    self.public_keys.put(value, value)
+                else:
+                    value = shared
+        setattr(self, key, value)
+
+    @staticmethod
+    def compact(transaction):
+        """
+        the compact form of a transaction when it has exactly the usual fields, otherwise the transaction as it is
+        """
+        if isinstance(transaction, TransactionRecord):
+            return transaction
+        if isinstance(transaction, dict) and len(transaction) == len(TransactionRecord.FIELDS) \
+                and all(k in transaction for k in TransactionRecord.FIELDS):
+            return TransactionRecord(transaction)
+        return transaction
+
+    @staticmethod
+    def plain(transaction):
+        if isinstance(transaction, Record):
+            return transaction.to_dict()
+        return transaction
+
+    def canonical_json(self):
+        """
+        the whole transaction as json with sorted keys, the way it is hashed as part of a block
+        """
+        return json.dumps(self.to_dict(), sort_keys=True)
+
+    def body_hash(self):
+        """
+        the hash that should be in transaction_hash
+        """
+        if self._body_hash is None:
+            body = {k: self[k] for k in self.HASHED_FIELDS}
+            self._body_hash = hashlib.sha256(json.dumps(body, sort_keys=True).encode()).digest()
+        return self._body_hash.hex()
+
+    def signed_bytes(self):
+        """
+        the bytes the signature is made over
+        """
+        signed = {k: self[k] for k in self.SIGNED_FIELDS}
+        return json.dumps(signed, sort_keys=True).encode("utf-8")
+
+    def signed_digest(self):
+        """
+        sha256 of signed_bytes(), enough to look up a signature check that was already done
+        """
+        if self._signed_hash is None:
+            self._signed_hash = hashlib.sha256(self.signed_bytes()).digest()
+        return self._signed_hash
+
+
+class BlockRecord(Record):
+    """
+    compact block. the json for the block hash is put together from its fields and the json of its
+    transactions instead of copying the block into a new dict, it gives the same bytes as
+    json.dumps(block, sort_keys=True) so hashes don't change. the hash is kept once it has been worked out.
+    current_hash isn't part of the hashed header, so it can be filled in after header_hash()
+    """
+    FIELDS = ['index', 'timestamp', 'transactions', 'difficulty', 'proof', 'previous_hash', 'current_hash']
+    HEX_FIELDS = frozenset(['previous_hash', 'current_hash'])
+    __slots__ = FIELDS + ['_header_hash']
+
+    HEADER_FIELDS = ['difficulty', 'index', 'previous_hash', 'proof', 'timestamp']
+
+    def __init__(self, data):
+        """
+        needs every header field, current_hash can be left out to be added later.
+        any fields a block shouldn't have are dropped, they were never part of the hash
+        """
+        for k in self.HEADER_FIELDS:
+            self.set_field(k, data[k])
+        self.transactions = [TransactionRecord.compact(t) for t in data['transactions']]
+        self.set_field('current_hash', data.get('current_hash'))
+        self._header_hash = None
+
+    def __getitem__(self, key):
+        if key == 'transactions':
+            return self.transactions
+        return Record.__getitem__(self, key)
+
+    def set_field(self, key, value):
+        if key == 'transactions':
+            value = [TransactionRecord.compact(t) for t in value]
+        Record.set_field(self, key, value)
+        if key != 'current_hash':
+            self._header_hash = None
+
+    def to_dict(self):
+        block = Record.to_dict(self)
+        block['transactions'] = [TransactionRecord.plain(t) for t in self.transactions]
+        return block
+
+    @staticmethod
+    def wrap(block):
+        """
+        block as a BlockRecord, raises KeyError if it is missing a field
+        """
+        if isinstance(block, BlockRecord):
+            return block
+        return BlockRecord(block)
+
+    @staticmethod
+    def compact(block):
+        """
+        the compact form of a block when it has exactly the usual fields, otherwise the block as it is.
+        used for blocks that are kept around, so nothing is lost from a block with fields of its own
+        """
+        if isinstance(block, BlockRecord):
+            return block
+        if isinstance(block, dict) and len(block) == len(BlockRecord.FIELDS) \
+                and all(k in block for k in BlockRecord.FIELDS) and isinstance(block['transactions'], list):
+            return BlockRecord(block)
+        return block
+
+    @staticmethod
+    def plain(block):
+        if isinstance(block, Record):
+            return block.to_dict()
+        return block
+
+    def transactions_json(self):
+        return '[' + ', '.join(t.canonical_json() if isinstance(t, TransactionRecord)
+                               else json.dumps(t, sort_keys=True) for t in self.transactions) + ']'
+
+    def header_json(self):
+        """
+        json of everything but current_hash, sorted keys
+        """
+        fields = ''.join(f'"{k}": {json.dumps(self[k])}, ' for k in self.HEADER_FIELDS)
+        return '{' + fields + '"transactions": ' + self.transactions_json() + '}'
+
+    def header_hash(self):
+        """
+        the hash that should be in current_hash
+        """
+        if self._header_hash is None:
+            self._header_hash = hashlib.sha256(self.header_json().encode()).digest()
+        return self._header_hash.hex()
+
+    def json_bytes(self):
+        """
+        the whole block as json, for broadcasting
+        """
+        return ('{"current_hash": ' + json.dumps(self['current_hash']) + ', ' + self.header_json()[1:]).encode()
@@ -0,0 +1,87 @@
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+
+class Peers:
+    """
+    the one http client everything uses to talk to other nodes, pools and miners.
+
+    all requests go through a shared requests session, so connections to a host are kept alive and reused
+    from a pool instead of a new tcp connection per call. every request gets a connect and read timeout,
+    so a peer that stops answering can't hold up a flask worker forever.
+
+    failed connections are retried with backoff. GETs are also retried on read errors and 502/503/504,
+    POSTs only when the connection couldn't be made, since by then the peer never saw the request.
+    """
+    # seconds to wait for a connection, and for the response once connected
+    connect_timeout = 3.05
+    read_timeout = 30
+
+    # retries after the first attempt, sleeping backoff * 2 ** (retry - 1) seconds between them
+    retries = 2
+    backoff = 0.2
+
+    # hosts kept in the pool, and connections kept open per host
+    pool_hosts = 64
+    pool_size = 16
+
+    session = None
+    lock = threading.Lock()
+
+    @staticmethod
+    def configure(connect_timeout=None, read_timeout=None, retries=None, backoff=None):
+        """
+        changes the timeouts and retries, the session is rebuilt on the next request
+        """
+        with Peers.lock:
+            if connect_timeout is not None:
+                Peers.connect_timeout = connect_timeout
+            if read_timeout is not None:
+                Peers.read_timeout = read_timeout
+            if retries is not None:
+                Peers.retries = retries
+            if backoff is not None:
+                Peers.backoff = backoff
+            if Peers.session is not None:
+                Peers.session.close()
+                Peers.session = None
+
+    @staticmethod
+    def new_session():
+        retry = Retry(total=Peers.retries, connect=Peers.retries, read=Peers.retries, status=Peers.retries,
+                      backoff_factor=Peers.backoff, status_forcelist=(502, 503, 504),
+                      allowed_methods=Retry.DEFAULT_ALLOWED_METHODS, raise_on_status=False)
+        adapter = HTTPAdapter(pool_connections=Peers.pool_hosts, pool_maxsize=Peers.pool_size, max_retries=retry)
+
+        session = requests.Session()
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        return session
+
+    @staticmethod
+    def get_session():
+        session = Peers.session
+        if session is None:
+            with Peers.lock:
+                if Peers.session is None:
+                    Peers.session = Peers.new_session()
+                session = Peers.session
+        return session
+
+    @staticmethod
+    def request(method, url, **kwargs):
+        """
+        same arguments as requests.request, with the default timeouts filled in
+        """
+        kwargs.setdefault('timeout', (Peers.connect_timeout, Peers.read_timeout))
+        return Peers.get_session().request(method, url, **kwargs)
+
+    @staticmethod
+    def get(url, **kwargs):
+        return Peers.request('GET', url, **kwargs)
+
+    @staticmethod
+    def post(url, **kwargs):
+        return Peers.request('POST', url, **kwargs)
@@ -0,0 +1,83 @@
+import os
+import base64
+import hashlib
+
+
+class Reconcile:
+    """
+    short transaction ids for syncing mempools between nodes.
+
+    instead of downloading a peer's whole mempool, a node sends the short ids of the transactions it
+    already has and gets back only the ones it is missing, plus the short ids of any it has that the peer doesn't.
+    a short id is the first few bytes of sha256(salt + transaction_hash). the salt is picked fresh by the
+    node asking, so two transactions that happen to share a short id won't keep clashing on every sync.
+    the ids are sent packed together as one base64 string rather than a list of hex strings.
+    """
+    # bytes per short id, plenty to tell apart the transactions of two mempools
+    id_size = 6
+    salt_size = 8
+
+    @staticmethod
+    def new_salt():
+        return os.urandom(Reconcile.salt_size)
+
+    @staticmethod
+    def short_id(salt, transaction_hash):
+        return hashlib.sha256(salt + str(transaction_hash).encode()).digest()[:Reconcile.id_size]
+
+    @staticmethod
+    def pack(short_ids):
+        return base64.b64encode(b''.join(short_ids)).decode()
+
+    @staticmethod
+    def unpack(packed):
+        """
+        splits a packed string back into short ids, raises ValueError if it isn't one
+        """
+        try:
+            data = base64.b64decode(packed, validate=True)
+        except (TypeError, ValueError):
+            raise ValueError('short ids are not valid base64')
+        if len(data) % Reconcile.id_size:
+            raise ValueError('short ids are not a whole number of ids')
+        return [data[i:i + Reconcile.id_size] for i in range(0, len(data), Reconcile.id_size)]
+
+    @staticmethod
+    def summary(transaction_hashes, salt=None):
+        """
+        what gets posted to /mempool/reconcile for the given transaction hashes
+        """
+        if salt is None:
+            salt = Reconcile.new_salt()
+        return {
+            'salt': salt.hex(),
+            'short_ids': Reconcile.pack(Reconcile.short_id(salt, h) for h in transaction_hashes)
+        }
+
+    @staticmethod
+    def read_summary(values):
+        """
+        the salt and the set of short ids from a posted summary, raises ValueError if it is malformed
+        """
+        if not isinstance(values, dict) or not isinstance(values.get('salt'), str) \
+                or not isinstance(values.get('short_ids'), str):
+            raise ValueError('summary needs a salt and short_ids')
+        salt = bytes.fromhex(values['salt'])
+        if len(salt) != Reconcile.salt_size:
+            raise ValueError('salt is the wrong size')
+        return salt, set(Reconcile.unpack(values['short_ids']))
+
+    @staticmethod
+    def compare(salt, theirs, transaction_hashes):
+        """
+        splits our transaction hashes against a peer's short ids.
+        returns (hashes of ours the peer is missing, short ids of theirs we don't have)
+        """
+        missing = []
+        ours = set()
+        for transaction_hash in transaction_hashes:
+            short_id = Reconcile.short_id(salt, transaction_hash)
+            ours.add(short_id)
+            if short_id not in theirs:
+                missing.append(transaction_hash)
+        return missing, [short_id for short_id in theirs if short_id not in ours]
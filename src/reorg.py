@@ -0,0 +1,90 @@
+import os
+import json
+from src.models import BlockRecord
+
+
+class Reorg:
+    """
+    switches the local chain over to a competing branch.
+    everything needed to finish the switch is written to a journal first: the fork point,
+    an undo record for every block being disconnected and the new blocks being connected.
+    if the node dies half way through, the journal is replayed on the next startup.
+    the journal is kept until the caller has brought its indexes over too and calls finish(),
+    so after a crash they can be reverted from the undo records instead of rebuilt.
+    """
+    def __init__(self, filename='data/blocks/reorg.json'):
+        self.filename = filename
+
+    def write_journal(self, journal):
+        temp = self.filename + '.tmp'
+        with open(temp, 'w') as f:
+            json.dump(journal, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp, self.filename)
+
+    def apply(self, chain, fork, new_blocks):
+        """
+        replaces every block after the fork height with new_blocks, finish() once the indexes have followed.
+        returns the undo records of the blocks that were disconnected, oldest first
+        """
+        self.check_fork(chain, fork)
+        undo = [{'height': height, 'block': chain[height]} for height in range(fork + 1, len(chain))]
+
+        journal = {
+            'fork': fork,
+            'undo': [{'height': record['height'], 'block': BlockRecord.plain(record['block'])} for record in undo],
+            'blocks': [BlockRecord.plain(block) for block in new_blocks]
+        }
+        self.write_journal(journal)
+        self.replay(chain, journal)
+
+        return undo
+
+    @staticmethod
+    def check_fork(chain, fork):
+        """
+        raises ValueError unless the fork is a height in the chain, or -1 to replace all of it
+        """
+        if isinstance(fork, bool) or not isinstance(fork, int) or not -1 <= fork < len(chain):
+            raise ValueError(f'fork height {fork!r} is outside the chain')
+
+    @staticmethod
+    def replay(chain, journal):
+        """
+        truncate back to the fork and append the new branch, the blocks are synced
+        before this returns so the journal can be removed. safe to run more than once for the same journal
+        """
+        fork = journal['fork']
+        Reorg.check_fork(chain, fork)
+        with chain.bulk():
+            chain.truncate(fork + 1)
+            for block in journal['blocks']:
+                chain.append(block)
+
+    def recover(self, chain):
+        """
+        finishes a reorg that was interrupted by a crash. returns its journal, the undo records are what
+        the indexes need to get back to the fork, and finish() once they have. None if there wasn't one
+        """
+        if not os.path.isfile(self.filename):
+            return None
+
+        try:
+            journal = json.load(open(self.filename, 'r'))
+            self.check_fork(chain, journal['fork'])
+        except (ValueError, KeyError, TypeError):
+            # the journal is swapped in atomically so a broken one means
+            # we crashed before the reorg touched the chain, and one that
+            # forks outside the chain could never be replayed
+            print(f"{self.filename} can't be replayed, discarding it")
+            os.remove(self.filename)
+            return None
+
+        print(f"finishing interrupted reorg from block {journal['fork'] + 1}")
+        self.replay(chain, journal)
+        return journal
+
+    def finish(self):
+        if os.path.isfile(self.filename):
+            os.remove(self.filename)
@@ -0,0 +1,455 @@
+import os
+import json
+import mmap
+import struct
+import sqlite3
+import hashlib
+import threading
+from contextlib import contextmanager
+from src.cache import LRUCache
+from src.codec import Codec
+from src.models import BlockRecord
+from src.wal import WriteAheadLog
+from src.keys import KeyTable
+
+
+class BlockStore:
+    """
+    append only block store, blocks are written one after the other into numbered
+    segment files and looked up through two persistent indexes.
+    each segment is a write ahead log of checksummed records with a group commit fsync policy,
+    the indexes are rebuilt from the segments after a crash so they never need syncing themselves:
+
+    index.dat  - one fixed width entry per block (segment, offset, length, hash),
+                 the entry for a height lives at height * ENTRY_SIZE so a lookup is a single seek.
+    hashes.db  - sqlite table of hash -> height written as blocks are, a lookup by hash reads one row
+                 so neither it nor startup depend on how long the chain is.
+    keys.dat   - the KeyTable, blocks refer to public keys by id instead of storing the key every time.
+
+    heights are positions in the chain, height 0 is the genesis block (block['index'] == 1).
+    """
+    SEGMENT_SIZE = 64 * 1024 * 1024
+    ENTRY = struct.Struct('<IQI32s')
+    RECORD_HEADER = WriteAheadLog.HEADER
+
+    def __init__(self, directory='data/blocks', sync_every=1, sync_interval=0, read_only=False):
+        self.directory = directory
+        self.lock = threading.RLock()
+        self.read_only = read_only
+
+        # fsync policy handed to the segment logs
+        self.sync_every = sync_every
+        self.sync_interval = sync_interval
+
+        # log for the segment currently being written
+        self.wal = None
+        self.segment = None
+        self.bulk_depth = 0
+
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+
+        self.index_path = os.path.join(directory, 'index.dat')
+        self.hashes_path = os.path.join(directory, 'hashes.db')
+
+        if not os.path.isfile(self.index_path):
+            open(self.index_path, 'wb').close()
+
+        # read only stores are opened by validation workers next to the node's own store,
+        # so they must never truncate or write anything
+        mode = 'rb' if read_only else 'r+b'
+        self.index_file = open(self.index_path, mode)
+
+        # public keys used in stored blocks, loaded before recover() since reindexing decodes blocks
+        self.keys = KeyTable(os.path.join(directory, 'keys.dat'), read_only=read_only)
+
+        # hash -> height table, opened when somebody first asks for a block by hash if we're read only
+        self.hashes = None
+        if not read_only:
+            self.open_hashes()
+
+        # read only memory maps of the segment files, keyed by segment number
+        self.maps = {}
+
+        # the block count comes straight from the size of the index, so opening the
+        # store costs the same no matter how long the chain is
+        self.count = os.path.getsize(self.index_path) // self.ENTRY.size
+        if not read_only:
+            self.recover()
+            self.open_segment(self.tip()[0])
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        for height in range(self.count):
+            yield self.get(height)
+
+    @staticmethod
+    def hash_key(block_hash):
+        """
+        turns a hex block hash into the 32 raw bytes stored in the indexes,
+        anything that isn't a sha256 hex digest is hashed down to 32 bytes instead.
+        """
+        try:
+            key = bytes.fromhex(block_hash)
+            if len(key) == 32:
+                return key
+        except (TypeError, ValueError):
+            pass
+        return hashlib.sha256(str(block_hash).encode()).digest()
+
+    def encode(self, block):
+        return Codec.dumps_block(BlockRecord.plain(block), self.keys)
+
+    def decode(self, payload):
+        return Codec.loads_block(payload, self.keys)
+
+    def segment_path(self, segment):
+        return os.path.join(self.directory, f'blk{segment:05d}.dat')
+
+    def recover(self):
+        """
+        brings the indexes back in line with the segment files after a crash:
+        index entries whose record is missing or fails its checksum are dropped,
+        good records written after the last index entry are indexed again,
+        and any torn record at the end of the last segment is cut off.
+        """
+        while self.count > 0 and not self.record_valid(self.count - 1):
+            print(f'block store: dropping torn block at height {self.count - 1}')
+            self.count -= 1
+        self.index_file.truncate(self.count * self.ENTRY.size)
+
+        segment, end = self.tip()
+        while os.path.isfile(self.segment_path(segment)):
+            path = self.segment_path(segment)
+            records, good_end = WriteAheadLog.scan(path, end)
+            for offset, payload in records:
+                print(f'block store: reindexing block at height {self.count}')
+                self.index_block(segment, offset, payload)
+
+            if good_end < os.path.getsize(path):
+                print(f'block store: truncating torn record in {path}')
+                with open(path, 'r+b') as f:
+                    f.truncate(good_end)
+                self.remove_segments_after(segment)
+                break
+
+            segment += 1
+            end = 0
+
+        self.catch_up_hashes()
+
+    def record_valid(self, height):
+        """
+        checks the record an index entry points at is all there and passes its checksum
+        """
+        segment, offset, length, _ = self.entry(height)
+        path = self.segment_path(segment)
+        if not os.path.isfile(path):
+            return False
+        with open(path, 'rb') as f:
+            f.seek(offset)
+            data = f.read(self.RECORD_HEADER.size + length)
+        return WriteAheadLog.read_record(data, 0) is not None
+
+    def open_hashes(self):
+        if self.read_only:
+            # validation workers only ever read, and must not create the database if it isn't there yet
+            self.hashes = sqlite3.connect(f'file:{self.hashes_path}?mode=ro', uri=True, check_same_thread=False)
+            return
+        self.hashes = sqlite3.connect(self.hashes_path, check_same_thread=False)
+        # the table is caught up from index.dat after a crash, so commits don't wait for a sync
+        self.hashes.execute('PRAGMA journal_mode=WAL')
+        self.hashes.execute('PRAGMA synchronous=NORMAL')
+        self.hashes.execute('CREATE TABLE IF NOT EXISTS hashes (hash BLOB PRIMARY KEY, height INTEGER) WITHOUT ROWID')
+        self.hashes.commit()
+
+    def hash_height(self, key):
+        row = self.hashes.execute('SELECT height FROM hashes WHERE hash = ?', (key,)).fetchone()
+        return row[0] if row is not None else None
+
+    def catch_up_hashes(self):
+        """
+        hashes are committed in the order blocks are written, so only the newest can be missing after a crash.
+        walks back from the tip to the last block that has its hash and adds the ones after it
+        """
+        height = self.count - 1
+        while height >= 0 and self.hash_height(self.entry(height)[3]) != height:
+            height -= 1
+        if height < self.count - 1:
+            print(f'block store: adding {self.count - 1 - height} missing blocks to the hash index')
+            self.hashes.executemany('INSERT OR REPLACE INTO hashes (hash, height) VALUES (?, ?)',
+                                    [(self.entry(h)[3], h) for h in range(height + 1, self.count)])
+            self.hashes.commit()
+
+    def remove_segments_after(self, segment):
+        later = segment + 1
+        while os.path.isfile(self.segment_path(later)):
+            os.remove(self.segment_path(later))
+            later += 1
+
+    def open_segment(self, segment):
+        """
+        switches writing over to a segment, syncing and closing the previous one
+        """
+        if self.wal is not None:
+            self.wal.close()
+        self.wal = WriteAheadLog(self.segment_path(segment), self.sync_every, self.sync_interval)
+        self.segment = segment
+        for i in range(self.bulk_depth):
+            self.wal.defer()
+
+    def entry(self, height):
+        """
+        returns the (segment, offset, length, hash) index entry for a height
+        """
+        with self.lock:
+            self.index_file.seek(height * self.ENTRY.size)
+            return self.ENTRY.unpack(self.index_file.read(self.ENTRY.size))
+
+    def segment_map(self, segment, end):
+        """
+        returns a memory map of a segment covering at least the first `end` bytes,
+        segments grow as blocks are appended so the map is redone when it is too short
+        """
+        segment_map = self.maps.get(segment)
+        if segment_map is None or len(segment_map) < end:
+            if segment_map is not None:
+                segment_map.close()
+            with open(self.segment_path(segment), 'rb') as f:
+                segment_map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            self.maps[segment] = segment_map
+        return segment_map
+
+    def close_maps(self, first_segment=0):
+        for segment in [s for s in self.maps if s >= first_segment]:
+            self.maps.pop(segment).close()
+
+    def read_record(self, segment, offset, length):
+        start = offset + self.RECORD_HEADER.size
+        with self.lock:
+            return self.segment_map(segment, start + length)[start:start + length]
+
+    def get(self, height):
+        """
+        returns the block stored at a height
+        """
+        if height < 0:
+            height += self.count
+        if not 0 <= height < self.count:
+            raise IndexError('block height out of range')
+
+        segment, offset, length, _ = self.entry(height)
+        return self.decode(self.read_record(segment, offset, length))
+
+    def height_of(self, block_hash):
+        """
+        returns the height of the block with the given hash, or None if we dont have it
+        """
+        key = self.hash_key(block_hash)
+        with self.lock:
+            if self.hashes is None:
+                try:
+                    self.open_hashes()
+                except sqlite3.Error:
+                    return None
+            height = self.hash_height(key)
+
+        # the height index has the final say, in case an entry was left behind in a crash
+        if height is None or height >= self.count or self.entry(height)[3] != key:
+            return None
+        return height
+
+    def get_by_hash(self, block_hash):
+        height = self.height_of(block_hash)
+        if height is None:
+            return None
+        return self.get(height)
+
+    def tip(self):
+        """
+        returns the (segment, end offset) the next block will be written at
+        """
+        if self.count == 0:
+            return 0, 0
+        segment, offset, length, _ = self.entry(self.count - 1)
+        return segment, offset + self.RECORD_HEADER.size + length
+
+    def index_block(self, segment, offset, payload, key=None):
+        """
+        adds the index and hash entries for a record that is already in a segment
+        """
+        if key is None:
+            key = self.hash_key(self.decode(payload)['current_hash'])
+
+        height = self.count
+        self.index_file.seek(height * self.ENTRY.size)
+        self.index_file.write(self.ENTRY.pack(segment, offset, len(payload), key))
+        self.index_file.flush()
+
+        self.hashes.execute('INSERT OR REPLACE INTO hashes (hash, height) VALUES (?, ?)', (key, height))
+        # bulk writes commit once at the end
+        if self.bulk_depth == 0:
+            self.hashes.commit()
+
+        self.count += 1
+        return height
+
+    def append(self, block):
+        """
+        writes a block to the end of the store and indexes it, returns its height.
+        the block is durable once the segment log syncs, see WriteAheadLog for the policy
+        """
+        payload = self.encode(block)
+        key = self.hash_key(block['current_hash'])
+
+        with self.lock:
+            segment, offset = self.tip()
+            if offset > 0 and offset + len(payload) > self.SEGMENT_SIZE:
+                segment += 1
+                offset = 0
+
+            if segment != self.segment:
+                self.open_segment(segment)
+
+            # anything past the tip is left over from a crash and is about to be cut off
+            if self.wal.size != offset:
+                self.close_maps(segment)
+                self.wal.truncate(offset)
+
+            self.wal.append(payload)
+            return self.index_block(segment, offset, payload, key)
+
+    def truncate(self, height):
+        """
+        drops every block from the given height onwards, the blocks below are not touched
+        """
+        with self.lock:
+            if height >= self.count:
+                return
+
+            segment, offset, _, _ = self.entry(height)
+            dropped = [(self.entry(h)[3],) for h in range(height, self.count)]
+
+            # reading a mapped page that was cut off the end of a file kills the process,
+            # so the maps have to go before we truncate anything
+            self.close_maps(segment)
+            self.wal.close()
+            self.wal = None
+            with open(self.segment_path(segment), 'r+b') as f:
+                f.truncate(offset)
+                os.fsync(f.fileno())
+
+            # remove any segments after the one we cut into
+            self.remove_segments_after(segment)
+
+            self.count = height
+            self.index_file.truncate(height * self.ENTRY.size)
+            self.index_file.flush()
+            self.hashes.executemany('DELETE FROM hashes WHERE hash = ?', dropped)
+            if self.bulk_depth == 0:
+                self.hashes.commit()
+            self.open_segment(segment)
+
+    def sync(self):
+        """
+        makes every block appended so far durable
+        """
+        with self.lock:
+            self.wal.sync()
+
+    @contextmanager
+    def bulk(self):
+        """
+        holds back fsyncs while lots of blocks are written (imports, reorgs)
+        and syncs once at the end
+        """
+        with self.lock:
+            self.bulk_depth += 1
+            self.wal.defer()
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.bulk_depth -= 1
+                self.wal.resume()
+                if self.bulk_depth == 0:
+                    self.hashes.commit()
+
+    def import_json(self, filename='data/chain.json'):
+        """
+        one off import of an old json lines chain file into the store
+        """
+        with open(filename, 'r') as s, self.bulk():
+            for line in s:
+                try:
+                    j = line.split('|')[-1]
+                    self.append(json.loads(j))
+
+                except ValueError:
+                    print("the json is rekt slut")
+                    continue
+
+    def close(self):
+        with self.lock:
+            self.close_maps()
+            if self.wal is not None:
+                self.wal.close()
+            self.index_file.close()
+            if self.hashes is not None:
+                self.hashes.commit()
+                self.hashes.close()
+            self.keys.close()
+
+
+class ChainView:
+    """
+    list like view of the chain on top of the block store, blocks are only decoded when
+    they are accessed and just the most recently used ones are kept in memory.
+    supports len(), indexing (including negative indexes and slices), iteration and append
+    so it can be used anywhere the old list of blocks was.
+    """
+    def __init__(self, store, cache_size=256):
+        self.store = store
+        self.cache = LRUCache(max_size=cache_size)
+
+    def __len__(self):
+        return len(self.store)
+
+    def __getitem__(self, item):
+        if isinstance(item, slice):
+            return [self[i] for i in range(*item.indices(len(self)))]
+
+        height = item
+        if height < 0:
+            height += len(self)
+        if not 0 <= height < len(self):
+            raise IndexError('chain index out of range')
+
+        block = self.cache.get(height)
+        if block is None:
+            # cached as a BlockRecord so its hash is only worked out once while it stays in the cache
+            block = BlockRecord.compact(self.store.get(height))
+            self.cache.put(height, block)
+        return block
+
+    def __iter__(self):
+        for height in range(len(self)):
+            yield self[height]
+
+    def append(self, block):
+        block = BlockRecord.compact(block)
+        height = self.store.append(block)
+        self.cache.put(height, block)
+        return height
+
+    def truncate(self, height):
+        """
+        drops every block from the given height onwards
+        """
+        self.store.truncate(height)
+        self.cache.discard_if(lambda cached_height: cached_height >= height)
+
+    def bulk(self):
+        return self.store.bulk()
@@ -18,17 +18,6 @@ class Write:
             block_dict = json.dumps(data, indent=6)
             file.write(block_dict)
 
-    @staticmethod
-    def write_chain(data, filename='data/chain.json'):
-        """
-        appends block to chain.json
-        """
-        # opens the file in append mode
-        with open(filename, 'a') as file:
-            block_dict = json.dumps(data)
-            file.write(block_dict)
-            file.write('\n')
-
 
 class Generate:
     @staticmethod
@@ -1,12 +1,43 @@
+import os
 import binascii
 import json
 import hashlib
+import multiprocessing
 from Crypto.Hash import SHA256
 from Crypto.PublicKey import RSA
 from Crypto.Signature import pkcs1_15
 from src.utils import Hash
+from src.cache import LRUCache
+from src.models import BlockRecord, TransactionRecord
 
 
+class Workers:
+    """
+    the worker processes that long chains and big batches of signatures are checked on.
+    the pool is forked once when the node starts, before it has any other threads. a process forked later,
+    from a request thread, would inherit any lock another thread held at that moment (the caches all have one)
+    and could hang on it forever, and forking a new pool for every request is slow anyway.
+    without a pool (one worker, or a platform that can't fork) everything is checked in the calling process.
+    """
+    pool = None
+
+    @staticmethod
+    def start(workers=None):
+        """
+        forks the pool, call before any threads are started
+        :param workers: <int> number of worker processes, defaults to the number of cores
+        """
+        workers = workers or os.cpu_count() or 1
+        if Workers.pool is not None or workers <= 1 or 'fork' not in multiprocessing.get_all_start_methods():
+            return
+        Workers.pool = multiprocessing.get_context('fork').Pool(workers)
+
+    @staticmethod
+    def stop():
+        if Workers.pool is not None:
+            Workers.pool.terminate()
+            Workers.pool = None
+
 
 class Funds:
     @staticmethod
@@ -46,6 +77,46 @@ class Funds:
             return False
 
 
+class PublicKeys:
+    """
+    parsed RsaKey objects and address hashes for recently seen public keys.
+    a handful of addresses (pools, exchanges) sign most transactions, so this saves
+    hex decoding and RSA.import_key on every signature check and the
+    SHA256 + RIPEMD160 double hash on every address check.
+    """
+    # public_key_hex -> [RsaKey or None, public key hash or None], each filled in the first time it is needed
+    cache = LRUCache(max_size=4096)
+
+    @staticmethod
+    def entry(public_key_hex):
+        entry = PublicKeys.cache.get(public_key_hex)
+        if entry is None:
+            entry = [None, None]
+            PublicKeys.cache.put(public_key_hex, entry)
+        return entry
+
+    @staticmethod
+    def import_key(public_key_hex):
+        """
+        returns the RsaKey for a hex DER public key, raises like RSA.import_key for a bad key
+        """
+        entry = PublicKeys.entry(public_key_hex)
+        if entry[0] is None:
+            entry[0] = RSA.import_key(binascii.unhexlify(public_key_hex.encode("utf-8")))
+        return entry[0]
+
+    @staticmethod
+    def key_hash(public_key_hex):
+        """
+        returns the address (RIPEMD160 of SHA256) of a hex public key
+        """
+        entry = PublicKeys.entry(public_key_hex)
+        if entry[1] is None:
+            entry[1] = Hash.calculate_hash(Hash.calculate_hash(public_key_hex, hash_function="sha256"),
+                                           hash_function="ripemd160")
+        return entry[1]
+
+
 class Signature:
 
     def sign_data(self, data, key):
@@ -62,26 +133,56 @@ class Signature:
         hash_object = SHA256.new(transaction_bytes)
         signature = pkcs1_15.new(key).sign(hash_object)
         return binascii.hexlify(signature).decode("utf-8")
+
+    # results of signature checks we've already done, keyed by digests of the public key, signature and message.
+    # the same transaction reaches us from several peers and gets checked again at every step,
+    # so most verifications during a flood are repeats
+    verified = LRUCache(max_size=50000)
+
     @staticmethod
     def validate_signature(public_key, signature, transaction_data):
         """
         Function for validation of signatures in submitted transactions
+        transaction_data is the signed dict, its already serialized bytes, or a TransactionRecord
+        whose kept digest answers a repeat check without serializing it again.
         will return True upon a valid signature,
         or False upon failing to verify a signature
         """
+        cache_key = None
         try:
-            signature_decoded = binascii.unhexlify(signature.encode("utf-8"))
-            public_key_decoded = binascii.unhexlify(public_key.encode("utf-8"))
-            public_key_object = RSA.import_key(public_key_decoded)
+            transaction_hash = None
+            if isinstance(transaction_data, TransactionRecord):
+                message_digest = transaction_data.signed_digest()
+            else:
+                if isinstance(transaction_data, bytes):
+                    transaction_bytes = transaction_data
+                else:
+                    transaction_bytes = json.dumps(transaction_data, sort_keys=True).encode("utf-8")
+                transaction_hash = SHA256.new(transaction_bytes)
+                message_digest = transaction_hash.digest()
+
+            cache_key = (hashlib.sha256(public_key.encode("utf-8")).digest(),
+                         hashlib.sha256(signature.encode("utf-8")).digest(),
+                         message_digest)
+            cached = Signature.verified.get(cache_key)
+            if cached is not None:
+                return cached
+
+            if transaction_hash is None:
+                transaction_hash = SHA256.new(transaction_data.signed_bytes())
 
-            transaction_bytes = json.dumps(transaction_data, sort_keys=True).encode("utf-8")
+            signature_decoded = binascii.unhexlify(signature.encode("utf-8"))
+            public_key_object = PublicKeys.import_key(public_key)
 
-            transaction_hash = SHA256.new(transaction_bytes)
             pkcs1_15.new(public_key_object).verify(transaction_hash, signature_decoded)
-            return True
+            valid = True
 
         except:
-            return False
+            valid = False
+
+        if cache_key is not None:
+            Signature.verified.put(cache_key, valid)
+        return valid
 
 
 class ValidChain:
@@ -99,30 +200,20 @@ class ValidChain:
         return guess_hash[:difficulty] == valid_guess
 
     @staticmethod
-    def valid_chain(chain):
+    def valid_chain(chain, start=0):
         """
         Determine if a given blockchain is valid
         :param chain: <list> A blockchain
+        :param start: <int> position of an already trusted block, validation starts from there
         :return: <bool> True if valid, False if not
         """
 
-        last_block = chain[0]
+        last_block = BlockRecord.wrap(chain[start])
 
-        current_index = 1
+        current_index = start + 1
 
         while current_index < len(chain):
-
-            # dictionary to store values to confirm appended hash
-            last_block_no_hash = {
-                'index': last_block['index'],
-                'timestamp': last_block['timestamp'],
-                'transactions': last_block['transactions'],
-                'difficulty': last_block['difficulty'],
-                'proof': last_block['proof'],
-                'previous_hash': last_block['previous_hash']
-            }
-
-            block = chain[current_index]
+            block = BlockRecord.wrap(chain[current_index])
 
             # Check that the hash of the blocks is consistent
             if last_block['current_hash'] != block['previous_hash']:
@@ -130,8 +221,8 @@ class ValidChain:
 
                 return False
             # Hash the block ourselves to check for tampering
-            if last_block['current_hash'] != Hash.hash(last_block_no_hash):
-                print(last_block['current_hash'], " not equal to ", Hash.hash(last_block_no_hash))
+            if last_block['current_hash'] != last_block.header_hash():
+                print(last_block['current_hash'], " not equal to ", last_block.header_hash())
                 return False
 
             # Check that the Proof of Work is correct
@@ -145,14 +236,63 @@ class ValidChain:
         return True
 
 
+    @staticmethod
+    def valid_chunk(task):
+        """
+        checks one chunk for valid_chain_parallel, runs in a worker process.
+        a task is either a list of blocks, or a (store directory, first height, last height)
+        range which the worker reads from the block store itself so the blocks never have to be pickled
+        """
+        if isinstance(task, tuple):
+            from src.store import BlockStore
+            directory, first, last = task
+            store = BlockStore(directory, read_only=True)
+            blocks = [store.get(height) for height in range(first, last + 1)]
+            store.close()
+        else:
+            blocks = task
+        return ValidChain.valid_chain(blocks)
+
+    @staticmethod
+    def valid_chain_parallel(chain, start=0, chunk_size=1000):
+        """
+        Same checks as valid_chain, spread over the Workers pool.
+        The chain is split into chunks that share their last block with the next chunk,
+        so the links across chunk boundaries still get checked.
+        Stops as soon as any chunk fails.
+        :param chain: <list> A blockchain, or a ChainView over the block store
+        :param start: <int> position of an already trusted block, validation starts from there
+        :return: <bool> True if valid, False if not
+        """
+        pool = Workers.pool
+        length = len(chain)
+
+        # a short chain isn't worth sending to the pool
+        if pool is None or length - start <= 2 * chunk_size:
+            return ValidChain.valid_chain(chain, start=start)
+
+        def tasks():
+            for first in range(start, length - 1, chunk_size):
+                last = min(first + chunk_size, length - 1)
+                if hasattr(chain, 'store'):
+                    yield chain.store.directory, first, last
+                else:
+                    yield chain[first:last + 1]
+
+        # the pool is shared, so on a failure the chunks already queued are left to finish and their results dropped
+        for valid in pool.imap_unordered(ValidChain.valid_chunk, tasks()):
+            if not valid:
+                return False
+        return True
+
+
 class Hash_Validation:
     def validate_pubkey_hash(self, pubkey, provided_pubkey_hash):
         """
         Validate whether a pubkey included in a transaction actually matches the pub_key hash
         included in the transaction, returns True if yes, False if no.
         """
-        local_key_hash = Hash.calculate_hash(Hash.calculate_hash(pubkey, hash_function="sha256"),
-                                              hash_function="ripemd160")
+        local_key_hash = PublicKeys.key_hash(pubkey)
         if provided_pubkey_hash != local_key_hash:
             return False
         return True
@@ -201,77 +341,92 @@ class Transaction:
         if Signature.validate_signature(public_key=public_key_hex, signature=signature, transaction_data=trans_data):
             return True
 
-        if not Signature.validate_signature(public_key=public_key_hex, signature=signature, transaction_data=trans_data):
-            print('signature failed verification')
-            return "signature malformed", 400
+        print('signature failed verification')
+        return "signature malformed", 400
 
 
     @staticmethod
-    def verify_transaction(values, chain):
+    def verify_transaction_signature(values):
         """
-        function to verify a transaction, transaction is hashed
-        and checked against the hash provided in the 'transaction_hash' field of the transaction
-        if valid, proceeds. Next the attached signature is validated against the public key, if valid, proceeds.
-        Finally if all checks have passed, the function will check if the address has enough balance for the transaction.
-        If all checks pass the function will return True and the transaction will be considered valid.
+        checks the transaction hash and the signature of a transaction.
+        neither needs the chain or the mempool, so batches of these can be checked in worker processes.
+        returns True if both are valid, False if not
         """
-        # If all API checks clear continue validation
-        print("New transaction: ", values, "\n...Validating...")
-
-        # Format for transaction data for hash verification
-        trans_to_be_hashed = {
-            'sender': values['sender'],
-            'recipient': values['recipient'],
-            'amount': values['amount'],
-            'fee': values['fee'],
-            'time_submitted': values['time_submitted'],
-            'previous_block_hash': values['previous_block_hash'],
-            'public_key_hex': values['public_key_hex']
-        }
+        record = values if isinstance(values, TransactionRecord) else TransactionRecord(values)
 
         # Check the local hash matches what has been provided
         # If this fails the transaction has been tampered with or a transmission error has occured
-        local_trans_hash = Hash.hash(trans_to_be_hashed)
-
-        # If the transaction fails hash verification we throw it out and return an error
-        if local_trans_hash != values['transaction_hash']:
+        if record.body_hash() != values['transaction_hash']:
             print("Transaction hash mismatch")
-            response = {'message': f'Transaction hash failed CRC'}
             return False
 
         # If the Hash is correct we proceed
         else:
             print("Transaction Hash verified!")
 
-        # Format of transaction data for signature verification
-        trans_to_be_validated = {
-            'sender': values['sender'],
-            'recipient': values['recipient'],
-            'amount': values['amount'],
-            'fee': values['fee'],
-            'time_submitted': values['time_submitted'],
-            'previous_block_hash': values['previous_block_hash'],
-            'public_key_hex': values['public_key_hex'],
-            'transaction_hash': values['transaction_hash']
-        }
-
-        # This line checks the signature against the broadcasted data If true we proceed
-        # If not we throw out the transaction as it has been tampered with
-        if Signature.validate_signature(values['public_key_hex'], values['signature'], trans_to_be_validated):
-
-            # Check if funds are available for the given address,
-            if Funds.enumerate_funds(address=
-                    values['sender'], chain=chain) >= values['amount']:
-                print('funds are available')
-
-                return True
-
-            # If theres not enough funds we throw an error and discard the transaction
-            else:
-                return False, "not enough funds"
-        # If the signature fails verification we throw out the transaction and throw an error
+        # This line checks the signature against the broadcasted data
+        # If it fails we throw out the transaction as it has been tampered with
+        if not Signature.validate_signature(values['public_key_hex'], values['signature'], record):
+            print("signature invalid")
+            return False
+        return True
+
+    @staticmethod
+    def check_signature(values):
+        """
+        verify_transaction_signature for a worker process, a malformed transaction just counts as invalid
+        """
+        try:
+            return Transaction.verify_transaction_signature(values)
+        except (KeyError, TypeError, ValueError):
+            return False
+
+    @staticmethod
+    def verify_signatures_parallel(transactions, chunk_size=64):
+        """
+        runs the hash and signature checks for a list of transactions on the Workers pool.
+        :param transactions: <list> transactions as received, not checked for missing fields yet
+        :return: <list> True or False for each transaction, in the same order
+        """
+        pool = Workers.pool
+
+        # same reasoning as valid_chain_parallel, small batches aren't worth the pool
+        if pool is None or len(transactions) <= chunk_size:
+            return [Transaction.check_signature(values) for values in transactions]
+
+        return pool.map(Transaction.check_signature, transactions, chunksize=chunk_size)
+
+    @staticmethod
+    def verify_transaction(values, chain=None, balances=None, signature_verified=False):
+        """
+        function to verify a transaction, transaction is hashed
+        and checked against the hash provided in the 'transaction_hash' field of the transaction
+        if valid, proceeds. Next the attached signature is validated against the public key, if valid, proceeds.
+        Finally if all checks have passed, the function will check if the address has enough balance for the amount and the fee.
+        If all checks pass the function will return True and the transaction will be considered valid.
+        The balance is read from the balance index when one is given (the mempool passes one with its pending
+        transactions applied), otherwise it is enumerated from the chain.
+        signature_verified skips the hash and signature checks when the caller has already done them.
+        """
+        # If all API checks clear continue validation
+        print("New transaction: ", values, "\n...Validating...")
+
+        if not signature_verified and not Transaction.verify_transaction_signature(values):
+            return False
+
+        # Check if funds are available for the given address,
+        if balances is not None:
+            available = balances.balance(values['sender'])
         else:
-            return False, "signature invalid"
+            available = Funds.enumerate_funds(address=values['sender'], chain=chain)
+
+        if available >= values['amount'] + values['fee']:
+            print('funds are available')
+            return True
+
+        # If theres not enough funds we throw an error and discard the transaction
+        print("not enough funds")
+        return False
 
 class ValidBlock:
     @staticmethod
@@ -286,16 +441,7 @@ class ValidBlock:
         proof = block_data['proof']
         proof_confirmed = ValidChain.validate_proof(last_proof, proof, difficulty)
         if proof_confirmed:
-            block = {
-                'index': block_data['index'],
-                'timestamp': block_data['timestamp'],
-                'transactions': block_data['transactions'],
-                'difficulty': block_data['difficulty'],
-                'proof': block_data['proof'],
-                'previous_hash': block_data['previous_hash']
-            }
-
-            block_hash = Hash.hash(block)
+            block_hash = BlockRecord.wrap(block_data).header_hash()
 
             if block_hash != block_data['current_hash']:
                 print("Provided block hash differs from locally hashed result")
@@ -0,0 +1,173 @@
+import os
+import zlib
+import struct
+import threading
+from time import time, sleep
+
+
+class WriteAheadLog:
+    """
+    append only log of checksummed records with a group commit fsync policy.
+
+    every record is written as (length, crc32) followed by the payload. instead of calling fsync
+    after every write the log syncs once `sync_every` records are waiting or once the oldest
+    unsynced record is `sync_interval` milliseconds old, whichever comes first.
+    sync_every=1 gives the old behaviour of every write being durable before append returns.
+
+    after a crash the end of the file may hold a half written record, recover() finds the
+    last record with a good checksum and cuts everything after it off.
+    """
+    HEADER = struct.Struct('<II')
+
+    def __init__(self, filename, sync_every=1, sync_interval=0):
+        self.filename = filename
+        self.sync_every = max(1, sync_every)
+        self.sync_interval = sync_interval
+        self.lock = threading.Lock()
+
+        self.file = open(filename, 'ab')
+        self.size = self.file.tell()
+
+        # records written but not fsynced yet, and when the oldest of them was written
+        self.pending = 0
+        self.pending_since = None
+
+        # while this is above zero appends don't sync, used for bulk imports
+        self.deferred = 0
+
+        self.closed = False
+        if sync_interval > 0:
+            timer = threading.Thread(target=self.sync_timer, daemon=True)
+            timer.start()
+
+    @staticmethod
+    def checksum(payload):
+        return zlib.crc32(payload) & 0xffffffff
+
+    @staticmethod
+    def read_record(data, offset):
+        """
+        returns the payload of the record at offset, or None if it is torn or fails its checksum
+        """
+        header_end = offset + WriteAheadLog.HEADER.size
+        if header_end > len(data):
+            return None
+
+        length, crc = WriteAheadLog.HEADER.unpack_from(data, offset)
+        if header_end + length > len(data):
+            return None
+
+        payload = bytes(data[header_end:header_end + length])
+        if WriteAheadLog.checksum(payload) != crc:
+            return None
+        return payload
+
+    @staticmethod
+    def scan(filename, start=0):
+        """
+        returns every good (offset, payload) record from start onwards and the offset where the good data ends
+        """
+        with open(filename, 'rb') as f:
+            data = f.read()
+
+        records = []
+        offset = start
+        while True:
+            payload = WriteAheadLog.read_record(data, offset)
+            if payload is None:
+                return records, offset
+            records.append((offset, payload))
+            offset += WriteAheadLog.HEADER.size + len(payload)
+
+    def recover(self, start=0):
+        """
+        checks the records from start onwards, truncates any torn tail and
+        returns the good records so the caller can replay or reindex them
+        """
+        with self.lock:
+            self.file.flush()
+            records, end = self.scan(self.filename, start)
+            if end < self.size:
+                print(f'{self.filename}: truncating {self.size - end} bytes of torn records')
+                self.truncate_file(end)
+            return records
+
+    def append(self, payload):
+        """
+        writes a record and returns the offset it starts at
+        """
+        with self.lock:
+            offset = self.size
+            self.file.write(self.HEADER.pack(len(payload), self.checksum(payload)))
+            self.file.write(payload)
+            self.size += self.HEADER.size + len(payload)
+
+            self.pending += 1
+            if self.pending_since is None:
+                self.pending_since = time()
+
+            if not self.deferred and self.pending >= self.sync_every:
+                self.sync_locked()
+            else:
+                self.file.flush()
+            return offset
+
+    def sync_locked(self):
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.pending = 0
+        self.pending_since = None
+
+    def sync(self):
+        """
+        makes every record written so far durable
+        """
+        with self.lock:
+            if self.pending and not self.closed:
+                self.sync_locked()
+
+    def sync_timer(self):
+        while not self.closed:
+            sleep(self.sync_interval / 1000)
+            with self.lock:
+                if self.closed or self.deferred or self.pending_since is None:
+                    continue
+                if (time() - self.pending_since) * 1000 >= self.sync_interval:
+                    self.sync_locked()
+
+    def defer(self):
+        """
+        stop syncing on every append until resume() is called, for bulk writes
+        """
+        with self.lock:
+            self.deferred += 1
+
+    def resume(self):
+        with self.lock:
+            self.deferred -= 1
+        if not self.deferred:
+            self.sync()
+
+    def truncate_file(self, offset):
+        self.file.flush()
+        self.file.truncate(offset)
+        os.fsync(self.file.fileno())
+        self.size = offset
+        self.pending = 0
+        self.pending_since = None
+
+    def truncate(self, offset):
+        """
+        cuts the log back to the given offset, everything before it is kept
+        """
+        with self.lock:
+            self.truncate_file(offset)
+
+    def close(self):
+        with self.lock:
+            if self.closed:
+                return
+            if self.pending:
+                self.sync_locked()
+            self.closed = True
+            self.file.close()
@@ -2,7 +2,6 @@ import base64
 import binascii
 import json
 import os
-import requests
 import qrcode
 from time import time
 from Crypto.PublicKey import RSA
@@ -10,6 +9,7 @@ from Crypto.Hash import SHA256
 from Crypto.Hash import RIPEMD160
 from Crypto.Signature import pkcs1_15
 from src.validation import Funds
+from src.peers import Peers
 import PySimpleGUI as sg
 import hashlib
 
@@ -212,7 +212,7 @@ class Wallet:
         headers = {'Content-type': 'application/json', 'Accept': 'text/plain'}
 
         for node in self.nodes:
-            response = requests.post(f'http://{node}/transactions/new', json=transaction, headers=headers)
+            response = Peers.post(f'http://{node}/transactions/new', json=transaction, headers=headers)
             if response.status_code == 201:
                 return True
 
@@ -244,6 +244,13 @@ class Wallet:
     # functions for getting blockchain data
 
     def get_balance(self):
+        # nodes keep a balance index, so we only need to fall back to counting through the chain for old nodes
+        for node in self.nodes:
+            response = Peers.get(f'http://{node}/balance/{self.public_key_hash}')
+
+            if response.status_code == 200:
+                return max(response.json()['balance'], 0)
+
         chain_balance = Funds.enumerate_funds(self.public_key_hash, self.chain)
         if chain_balance > 0:
             return chain_balance
@@ -251,9 +258,39 @@ class Wallet:
         if chain_balance == False:
             return 0
 
+    def get_transaction_history(self, page_size=100):
+        """
+        returns every transaction our address appears in, newest first
+        """
+        for node in self.nodes:
+            # a node that fails part way is asked again from the start, pages from different nodes don't mix
+            transactions = []
+            cursor = None
+            while True:
+                params = {'limit': page_size}
+                if cursor is not None:
+                    params['cursor'] = cursor
+                response = Peers.get(f'http://{node}/address/{self.public_key_hash}/transactions', params=params)
+                if response.status_code != 200:
+                    break
+
+                page = response.json()
+                transactions.extend(entry['transaction'] for entry in page['transactions'])
+                cursor = page['next_cursor']
+                if cursor is None:
+                    return transactions
+
+        # none of our nodes have the address index, so we fall back to scanning the whole chain like older wallets
+        transactions = []
+        for block in reversed(self.get_chain() or []):
+            for transaction in reversed(block['transactions']):
+                if self.public_key_hash in (transaction['sender'], transaction['recipient']):
+                    transactions.append(transaction)
+        return transactions
+
     def get_block_height(self):
         for node in self.nodes:
-            response = requests.get(f'http://{node}/chain')
+            response = Peers.get(f'http://{node}/chain')
 
             if response.status_code == 200:
                 length = response.json()['length']
@@ -263,7 +300,7 @@ class Wallet:
 
     def get_last_block_hash(self):
         for node in self.nodes:
-            response = requests.get(f'http://{node}/chain')
+            response = Peers.get(f'http://{node}/chain')
 
         if response.status_code == 200:
             length = response.json()['length']
@@ -273,7 +310,7 @@ class Wallet:
 
     def get_chain(self):
         for node in self.nodes:
-            response = requests.get(f'http://{node}/chain')
+            response = Peers.get(f'http://{node}/chain')
 
         if response.status_code == 200:
             chain = response.json()['chain']
@@ -310,22 +347,19 @@ while True:
 
     if event in 'Transaction History':
         window.close()
-        # code to find relevant transactions in the blockchain pertaining to our wallets address
-        chain = wallet.get_chain()  # get the chain
+        # the node keeps an index of every transaction our address appears in,
+        # so we page through that instead of downloading and scanning the whole chain
         sent = []  # list for storing sent transactions
         received = []  # list for storing received transactions
-        for block in chain:  # iterate through the blockchain
-            for transaction in block['transactions']:
-                # code to find received transactions
-                if transaction['recipient'] == wallet.public_key_hash:
-                    print("received: ", transaction)
-                    received.append(transaction)
-                # code to find sent transactions
-                if transaction['sender'] == wallet.public_key_hash:
-                    print("sent: ", transaction)
-                    sent.append(transaction)
-                else:
-                    continue
+        for transaction in wallet.get_transaction_history():
+            # code to find received transactions
+            if transaction['recipient'] == wallet.public_key_hash:
+                print("received: ", transaction)
+                received.append(transaction)
+            # code to find sent transactions
+            if transaction['sender'] == wallet.public_key_hash:
+                print("sent: ", transaction)
+                sent.append(transaction)
 
         sent_json = json.dumps(sent, indent=2)
         received_json = json.dumps(received, indent=2)